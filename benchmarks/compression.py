@@ -0,0 +1,74 @@
+import argparse
+import timeit
+from main.messages import DNSHeader, DNSMessage, DNSQuestion, DNSRecord
+from main.utils import encode_name
+from main.constants import *
+
+
+def _record(name, rtype, rdata, ttl=300):
+    if rtype in {NS, CNAME, PTR}:
+        rdata = rdata.encode()
+        return DNSRecord(name, rtype, 1, ttl, len(encode_name(rdata.decode())), rdata)
+    return DNSRecord(name, rtype, 1, ttl, len(rdata), rdata)
+
+
+def _message(qname, qtype, answers=(), authorities=(), additionals=()):
+    return DNSMessage(DNSHeader(id=1, flags=0x8180, qdcount=1, ancount=len(answers),
+                                nscount=len(authorities), arcount=len(additionals)),
+                      questions=[DNSQuestion(qname, qtype, 1)],
+                      answers=list(answers),
+                      authorities=list(authorities),
+                      additionals=list(additionals))
+
+
+def sample_messages():
+    multi_a = _message('www.example.com.', A, [
+        _record('www.example.com.', A, bytes([192, 0, 2, k]))
+        for k in range(16)
+    ])
+
+    cname_chain = _message('mail.google.com.', AAAA, [
+        _record('mail.google.com.', CNAME, 'googlemail.l.google.com.'),
+    ] + [
+        _record('googlemail.l.google.com.', AAAA, bytes(15) + bytes([k]))
+        for k in range(8)
+    ])
+
+    tld_servers = ['{}.gtld-servers.net.'.format(letter) for letter in 'abcdefghijklm']
+    referral = _message('www.example.com.', A, authorities=[
+        _record('com.', NS, server, ttl=172800)
+        for server in tld_servers
+    ], additionals=[
+        _record(server, A, bytes([192, 5, 6, k]), ttl=172800)
+        for k, server in enumerate(tld_servers)
+    ] + [
+        _record(server, AAAA, bytes(15) + bytes([k]), ttl=172800)
+        for k, server in enumerate(tld_servers)
+    ])
+
+    return {
+        '16 x A': multi_a,
+        'CNAME + 8 x AAAA': cname_chain,
+        'root referral (13 NS + 26 glue)': referral,
+    }
+
+
+def main():
+    p = argparse.ArgumentParser(description='Byte savings and cost of name compression in DNSMessage.to_bytes')
+    p.add_argument('--number', type=int, default=2000, help='Serializations per measurement')
+    args = p.parse_args()
+
+    print('{:<34} {:>8} {:>10} {:>7} {:>12} {:>14}'.format(
+        'message', 'plain B', 'compact B', 'saved', 'plain us', 'compact us'))
+    for label, message in sample_messages().items():
+        plain = message.to_bytes(compress=False)
+        compact = message.to_bytes()
+        plain_time = timeit.timeit(lambda: message.to_bytes(compress=False), number=args.number)
+        compact_time = timeit.timeit(message.to_bytes, number=args.number)
+        print('{:<34} {:>8} {:>10} {:>6.1f}% {:>12.1f} {:>14.1f}'.format(
+            label, len(plain), len(compact), 100 * (1 - len(compact) / len(plain)),
+            plain_time / args.number * 1e6, compact_time / args.number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
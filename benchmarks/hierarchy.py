@@ -0,0 +1,265 @@
+import argparse
+import asyncio
+import logging
+import random
+import struct
+import threading
+from typing import List, Optional
+from main.messages import DNSHeader, DNSMessage, DNSRecord, QR, AA
+from main.utils import encode_name, read_tcp_message, write_tcp_message
+from main.constants import *
+
+ROOT_IP = '127.0.1.1'
+
+
+def _tld_ip(j):
+    return '127.0.2.{}'.format(j + 1)
+
+
+def _record(name, rtype, rdata, ttl):
+    if rtype in {NS, CNAME, PTR}:
+        return DNSRecord(name, rtype, 1, ttl, len(encode_name(rdata)), rdata.encode())
+    return DNSRecord(name, rtype, 1, ttl, len(rdata), rdata)
+
+
+def _soa(zone, minimum):
+    rdata = encode_name('ns.' + zone if zone != '.' else 'ns.root.') + encode_name('hostmaster.invalid.') + \
+        struct.pack('!IIIII', 1, 3600, 600, 86400, minimum)
+    return _record(zone, SOA, rdata, minimum)
+
+
+def _index(label, prefix) -> Optional[int]:
+    # 'zone12' -> 12
+    if label.startswith(prefix) and label[len(prefix):].isdigit():
+        return int(label[len(prefix):])
+
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, hierarchy, ip):
+        self._hierarchy = hierarchy
+        self._ip = ip
+        self._transport = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def datagram_received(self, data, addr):
+        hierarchy = self._hierarchy
+        if hierarchy.loss and hierarchy.rng.random() < hierarchy.loss:
+            hierarchy.dropped += 1
+            return
+        response = hierarchy.answer(self._ip, data)
+        if response is None:
+            return
+        delay = hierarchy.delay()
+        if delay:
+            asyncio.get_running_loop().call_later(delay, self._transport.sendto, response, addr)
+        else:
+            self._transport.sendto(response, addr)
+
+
+class FakeHierarchy:
+    # Root, TLD and authoritative servers on loopback addresses, all on one port:
+    #   root          127.0.1.1  delegates tld<j>.
+    #   tld<j>.       127.0.2.<j+1>  delegates zone<i>.tld<j>. with in-bailiwick glue
+    #   zone<i>.tld<j>.  127.0.3.<n>, zones are spread over `auth_servers` addresses
+    # and every zone holds host<k>.zone<i>.tld<j>. A records. Linux routes all of 127/8 to lo,
+    # other systems need the addresses configured as aliases first.
+    def __init__(self, port=5300, tlds=4, zones_per_tld=50, names_per_zone=100, auth_servers=4,
+                 latency=0.0, jitter=0.0, loss=0.0, ttl=300, negative_ttl=60, seed=0):
+        self.port = port
+        self.tlds = tlds
+        self.zones_per_tld = zones_per_tld
+        self.names_per_zone = names_per_zone
+        self.auth_servers = auth_servers
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.rng = random.Random(seed)
+        self.queries = {'root': 0, 'tld': 0, 'auth': 0}
+        self.dropped = 0
+        self._closables = []
+        self._loop = None
+
+    @property
+    def root_ip(self):
+        return ROOT_IP
+
+    def _auth_ip(self, i, j):
+        return '127.0.3.{}'.format((j * self.zones_per_tld + i) % self.auth_servers + 1)
+
+    def addresses(self) -> List[str]:
+        return [ROOT_IP] + [_tld_ip(j) for j in range(self.tlds)] + \
+            ['127.0.3.{}'.format(n + 1) for n in range(min(self.auth_servers, self.tlds * self.zones_per_tld))]
+
+    def names(self) -> List[str]:
+        return [
+            'host{}.zone{}.tld{}.'.format(k, i, j)
+            for j in range(self.tlds)
+            for i in range(self.zones_per_tld)
+            for k in range(self.names_per_zone)
+        ]
+
+    def missing_names(self, count) -> List[str]:
+        # names in existing zones that get NXDOMAIN
+        return [
+            'missing{}.zone{}.tld{}.'.format(n, n % self.zones_per_tld, n // self.zones_per_tld % self.tlds)
+            for n in range(count)
+        ]
+
+    def delay(self) -> float:
+        if self.jitter:
+            return max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+        return self.latency
+
+    def answer(self, ip, data) -> Optional[bytes]:
+        try:
+            query, _ = DNSMessage.parse(data)
+            question = query.questions[0]
+        except Exception:
+            return None
+
+        labels = question.qname.lower().rstrip('.').split('.')
+        tld = _index(labels[-1], 'tld') if labels[-1] else None
+        if tld is not None and tld >= self.tlds:
+            tld = None
+        zone = _index(labels[-2], 'zone') if len(labels) > 1 else None
+        if zone is not None and zone >= self.zones_per_tld:
+            zone = None
+
+        answers, authorities, additionals = [], [], []
+        rcode, flags = NOERROR, QR
+        if ip == ROOT_IP:
+            self.queries['root'] += 1
+            if tld is None:
+                rcode, authorities = NAMEERROR, [_soa('.', self.negative_ttl)]
+            else:
+                ns = 'ns.tld{}.'.format(tld)
+                authorities = [_record('tld{}.'.format(tld), NS, ns, 172800)]
+                additionals = [_record(ns, A, bytes(map(int, _tld_ip(tld).split('.'))), 172800)]
+        elif ip.startswith('127.0.2.'):
+            self.queries['tld'] += 1
+            apex = 'tld{}.'.format(tld)
+            if zone is not None and len(labels) > 2:
+                ns = 'ns.zone{}.{}'.format(zone, apex)
+                authorities = [_record('zone{}.{}'.format(zone, apex), NS, ns, 86400)]
+                additionals = [_record(ns, A, bytes(map(int, self._auth_ip(zone, tld).split('.'))), 86400)]
+            elif question.qname.lower() == 'ns.' + apex and question.qtype == A:
+                flags |= AA
+                answers = [_record(question.qname, A, bytes(map(int, _tld_ip(tld).split('.'))), 172800)]
+            else:
+                flags |= AA
+                rcode, authorities = NAMEERROR, [_soa(apex, self.negative_ttl)]
+        else:
+            self.queries['auth'] += 1
+            flags |= AA
+            apex = 'zone{}.tld{}.'.format(zone, tld)
+            host = _index(labels[0], 'host') if len(labels) == 3 else None
+            if len(labels) == 3 and labels[0] == 'ns':
+                address = bytes(map(int, self._auth_ip(zone, tld).split('.')))
+            elif host is not None and host < self.names_per_zone:
+                address = bytes((10, tld % 256, zone % 256, host % 256))
+            else:
+                address = None
+
+            if address is None:
+                rcode, authorities = NAMEERROR, [_soa(apex, self.negative_ttl)]
+            elif question.qtype == A:
+                answers = [_record(question.qname, A, address, self.ttl)]
+            else:
+                authorities = [_soa(apex, self.negative_ttl)]
+
+        return DNSMessage(DNSHeader(id=query.header.id, flags=flags | rcode, qdcount=1, ancount=len(answers),
+                                    nscount=len(authorities), arcount=len(additionals)),
+                          questions=[question],
+                          answers=answers,
+                          authorities=authorities,
+                          additionals=additionals).to_bytes()
+
+    async def _handle_tcp(self, ip, reader, writer):
+        try:
+            while True:
+                data = await read_tcp_message(reader)
+                response = self.answer(ip, data)
+                if response is None:
+                    break
+                delay = self.delay()
+                if delay:
+                    await asyncio.sleep(delay)
+                await write_tcp_message(writer, response)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for ip in self.addresses():
+            transport, _ = await loop.create_datagram_endpoint(lambda ip=ip: _UDPProtocol(self, ip),
+                                                               local_addr=(ip, self.port))
+            server = await asyncio.start_server(lambda r, w, ip=ip: self._handle_tcp(ip, r, w), ip, self.port)
+            self._closables += [transport, server]
+        logging.info('[{}] serving {} zones on {} addresses, port {}'.format(
+            self.__class__.__name__, self.tlds * self.zones_per_tld, len(self.addresses()), self.port))
+
+    def stop(self):
+        for closable in self._closables:
+            closable.close()
+        self._closables = []
+
+    def start_in_thread(self):
+        # serves from a loop of its own, so it runs next to a blocking or asyncio caller
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.start(), self._loop).result()
+
+    def stop_thread(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self.stop)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
+
+
+def add_arguments(p):
+    p.add_argument('--upstream_port', type=int, default=5300, help='Port of the fake nameservers')
+    p.add_argument('--tlds', type=int, default=4, help='Number of TLDs under the fake root')
+    p.add_argument('--zones_per_tld', type=int, default=50, help='Delegated zones per TLD')
+    p.add_argument('--names_per_zone', type=int, default=100, help='A records per zone')
+    p.add_argument('--auth_servers', type=int, default=4, help='Addresses the zones are spread over')
+    p.add_argument('--latency', type=float, default=0.0, help='Seconds each UDP and TCP answer is delayed by')
+    p.add_argument('--jitter', type=float, default=0.0, help='Latency varies uniformly by up to this many seconds')
+    p.add_argument('--loss', type=float, default=0.0, help='Fraction of UDP queries that are dropped')
+    p.add_argument('--ttl', type=int, default=300, help='TTL of the A records')
+    p.add_argument('--seed', type=int, default=0, help='Seed of latency, loss and the query mix')
+
+
+def from_args(args) -> FakeHierarchy:
+    return FakeHierarchy(args.upstream_port, args.tlds, args.zones_per_tld, args.names_per_zone, args.auth_servers,
+                         args.latency, args.jitter, args.loss, args.ttl, seed=args.seed)
+
+
+async def _serve_forever(hierarchy):
+    await hierarchy.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        hierarchy.stop()
+
+
+def main():
+    p = argparse.ArgumentParser(description='Fake root, TLD and authoritative nameservers on loopback addresses')
+    add_arguments(p)
+    args = p.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    hierarchy = from_args(args)
+    try:
+        asyncio.run(_serve_forever(hierarchy))
+    except KeyboardInterrupt:
+        logging.info('Answered {}, dropped {}'.format(hierarchy.queries, hierarchy.dropped))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+import argparse
+import asyncio
+import bisect
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from benchmarks.hierarchy import add_arguments, from_args
+from main.messages import DNSMessage, DNSQuestion
+from main.utils import read_tcp_message, write_tcp_message
+from main.constants import *
+
+
+def query_mix(names, missing, count, zipf, cold_ratio, nxdomain_ratio, seed) -> list:
+    # warm queries pick names by a Zipf law over a fixed popularity order, cold ones take a name
+    # that wasn't asked before, the same seed always gives the same sequence
+    rng = random.Random(seed)
+    popular = list(names)
+    rng.shuffle(popular)
+    unseen = iter(reversed(popular))
+    cum_weights = list(itertools.accumulate(1 / rank ** zipf for rank in range(1, len(popular) + 1)))
+    asked = set()
+
+    queries = []
+    for _ in range(count):
+        draw = rng.random()
+        if draw < nxdomain_ratio:
+            name = rng.choice(missing)
+        elif draw < nxdomain_ratio + cold_ratio:
+            name = next((n for n in unseen if n not in asked), None) or rng.choice(popular)
+        else:
+            name = popular[bisect.bisect_left(cum_weights, rng.random() * cum_weights[-1])]
+        asked.add(name)
+        queries.append(name)
+    return queries
+
+
+class _ClientProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.pending = {}  # query ID -> future
+
+    def datagram_received(self, data, addr):
+        future = self.pending.pop(data[:2], None)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+
+class LoadDriver:
+    def __init__(self, host, port, protocol, concurrency, timeout):
+        self._host = host
+        self._port = port
+        self._protocol = protocol
+        self._concurrency = concurrency
+        self._timeout = timeout
+        self.latencies = []
+        self.rcodes = {}
+        self.timeouts = 0
+        self.errors = 0
+
+    def _record(self, started, response):
+        self.latencies.append(time.perf_counter() - started)
+        rcode = RCODE_NAMES.get(response[3] & 0xF, response[3] & 0xF)
+        self.rcodes[rcode] = self.rcodes.get(rcode, 0) + 1
+
+    async def _udp_client(self, queries):
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(_ClientProtocol,
+                                                                  remote_addr=(self._host, self._port))
+        try:
+            for data in queries:
+                future = protocol.pending[data[:2]] = loop.create_future()
+                started = time.perf_counter()
+                transport.sendto(data)
+                try:
+                    self._record(started, await asyncio.wait_for(future, self._timeout))
+                except asyncio.TimeoutError:
+                    protocol.pending.pop(data[:2], None)
+                    self.timeouts += 1
+        finally:
+            transport.close()
+
+    async def _tcp_client(self, queries):
+        connection = None
+        for data in queries:
+            started = time.perf_counter()
+            for attempt in range(2):
+                try:
+                    if connection is None:
+                        connection = await asyncio.open_connection(self._host, self._port)
+                    await write_tcp_message(connection[1], data)
+                    self._record(started, await asyncio.wait_for(read_tcp_message(connection[0]), self._timeout))
+                    break
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    # the server closed the connection, e.g. after its idle timeout
+                    connection = None
+                    if attempt:
+                        self.errors += 1
+                except asyncio.TimeoutError:
+                    connection[1].close()
+                    connection = None
+                    self.timeouts += 1
+                    break
+        if connection is not None:
+            connection[1].close()
+
+    async def run(self, names) -> float:
+        queries = []
+        for k, name in enumerate(names):
+            request = DNSMessage.from_question(DNSQuestion(name, A, 1)).with_RD(is_desired=True)
+            request.header.id = k % 2 ** 16
+            queries.append(request.to_bytes())
+
+        client = self._udp_client if self._protocol == 'udp' else self._tcp_client
+        started = time.perf_counter()
+        await asyncio.gather(*[client(queries[k::self._concurrency]) for k in range(self._concurrency)])
+        return time.perf_counter() - started
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else float('nan')
+
+
+def fetch_stats(host, port) -> dict:
+    with urllib.request.urlopen('http://{}:{}/stats'.format(host, port), timeout=2) as response:
+        return json.loads(response.read())
+
+
+def hit_rates(stats) -> dict:
+    lookups = stats.get('metrics', {}).get('counters', {}).get('cache_lookups', {})
+    totals = {}
+    for labels, count in lookups.items():
+        cache = labels.split('"')[1]
+        hits, total = totals.get(cache, (0, 0))
+        totals[cache] = (hits + count * ('result="hit"' in labels), total + count)
+    return {cache: hits / total for cache, (hits, total) in totals.items() if total}
+
+
+async def wait_until_serving(host, port, deadline):
+    # an MX query is refused right away with NOTIMP, without touching the caches or the fake servers
+    probe = LoadDriver(host, port, 'udp', 1, 0.2)
+    request = DNSMessage.from_question(DNSQuestion('ready.invalid.', 15, 1)).to_bytes()
+    while time.monotonic() < deadline:
+        await probe._udp_client([request])
+        if probe.latencies:
+            return
+    raise RuntimeError('Resolver did not come up on {}:{}'.format(host, port))
+
+
+def start_resolver(args, cache_location) -> subprocess.Popen:
+    command = [sys.executable, '-m', 'main.runner',
+               '--logging_level', 'WARNING',
+               '--engine', args.engine,
+               '--protocol', 'both',
+               '--host', args.host,
+               '--port', str(args.port),
+               '--root_servers', args.root_ip,
+               '--upstream_port', str(args.upstream_port),
+               '--cache_location', cache_location,
+               '--shared_cache_location', '',
+               '--hot_set_location', '',
+               '--metrics_host', args.host,
+               '--metrics_port', str(args.metrics_port),
+               '--workers', str(args.workers)] + args.resolver_args
+    return subprocess.Popen(command)
+
+
+def main():
+    p = argparse.ArgumentParser(description='Load test of the resolver against a fake nameserver hierarchy')
+    add_arguments(p)
+    p.add_argument('--engine', default='asyncio', choices=['pykka', 'asyncio'], help='Resolver engine to start')
+    p.add_argument('--workers', type=int, default=1, help='Resolver worker processes')
+    p.add_argument('--protocol', default='udp', choices=['udp', 'tcp'], help='Protocol of the clients')
+    p.add_argument('--host', default='127.0.0.1', help='Address the resolver listens on')
+    p.add_argument('--port', type=int, default=5353, help='Port the resolver listens on')
+    p.add_argument('--metrics_port', type=int, default=9154, help='Metrics port of the resolver')
+    p.add_argument('--external', action='store_true',
+                   help='Drive an already running resolver instead of starting one, it must use the fake root')
+    p.add_argument('--queries', type=int, default=20000, help='Number of queries sent')
+    p.add_argument('--concurrency', type=int, default=50, help='Clients sending queries one after another')
+    p.add_argument('--timeout', type=float, default=2.0, help='Seconds a client waits for an answer')
+    p.add_argument('--zipf', type=float, default=1.1, help='Exponent of the name popularity distribution')
+    p.add_argument('--cold_ratio', type=float, default=0.05, help='Fraction of queries for names not asked before')
+    p.add_argument('--nxdomain_ratio', type=float, default=0.0, help='Fraction of queries for missing names')
+    p.add_argument('--save', help='Write the query mix to this file, one name per line')
+    p.add_argument('--replay', help='Send the names of this file instead of generating a mix')
+    p.add_argument('resolver_args', nargs=argparse.REMAINDER, help='Extra resolver options after `--`')
+    args = p.parse_args()
+    args.resolver_args = [a for a in args.resolver_args if a != '--']
+
+    hierarchy = from_args(args)
+    args.root_ip = hierarchy.root_ip
+    if args.replay:
+        with open(args.replay) as f:
+            names = [line.strip() for line in f if line.strip()]
+    else:
+        names = query_mix(hierarchy.names(), hierarchy.missing_names(1000), args.queries,
+                          args.zipf, args.cold_ratio, args.nxdomain_ratio, args.seed)
+    if args.save:
+        with open(args.save, 'w') as f:
+            f.write('\n'.join(names) + '\n')
+
+    hierarchy.start_in_thread()
+    resolver = None
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            if not args.external:
+                resolver = start_resolver(args, os.path.join(directory, 'cache.db'))
+            asyncio.run(wait_until_serving(args.host, args.port, time.monotonic() + 15))
+
+            driver = LoadDriver(args.host, args.port, args.protocol, args.concurrency, args.timeout)
+            elapsed = asyncio.run(driver.run(names))
+            try:
+                stats = fetch_stats(args.host, args.metrics_port)
+            except Exception as e:
+                print('No resolver stats: {}'.format(e))
+                stats = {}
+        finally:
+            if resolver is not None:
+                resolver.terminate()
+                resolver.wait()
+            hierarchy.stop_thread()
+
+    latencies = sorted(driver.latencies)
+    print('queries       {} in {:.2f}s, {} distinct names'.format(len(names), elapsed, len(set(names))))
+    print('qps           {:.0f}'.format(len(latencies) / elapsed))
+    print('latency ms    p50 {:.3f}  p99 {:.3f}  p999 {:.3f}  max {:.3f}'.format(
+        *(1000 * percentile(latencies, f) for f in (0.5, 0.99, 0.999, 1.0))))
+    print('timeouts      {}  errors {}'.format(driver.timeouts, driver.errors))
+    print('rcodes        {}'.format(' '.join('{}={}'.format(k, v) for k, v in sorted(driver.rcodes.items()))))
+    print('upstream      {}  dropped {}'.format(
+        ' '.join('{}={}'.format(k, v) for k, v in hierarchy.queries.items()), hierarchy.dropped))
+    rates = hit_rates(stats)
+    if rates:
+        print('cache hits    {}'.format(' '.join('{}={:.1%}'.format(k, v) for k, v in sorted(rates.items()))))
+    drops = stats.get('metrics', {}).get('counters', {}).get('udp_dropped', {})
+    if drops:
+        print('server drops  {}'.format(' '.join('{}={}'.format(k, v) for k, v in sorted(drops.items()))))
+
+
+if __name__ == '__main__':
+    main()
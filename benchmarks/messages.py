@@ -0,0 +1,58 @@
+import argparse
+import timeit
+from benchmarks.compression import sample_messages
+from main.messages import DNSMessage, DNSRecord
+from main.utils import encode_name, parse_name
+
+
+def _parse_all(data):
+    message, _ = DNSMessage.parse(data)
+    message.additionals  # decodes every section
+    return message
+
+
+def _last_record_offset(data):
+    message, i = DNSMessage.parse(data)
+    h = message.header
+    names = {}
+    start = i
+    for _ in range(h.ancount + h.nscount + h.arcount):
+        start = i
+        _, i = DNSRecord.parse(data, i, names)
+    return start
+
+
+def cases():
+    for label, message in sample_messages().items():
+        data = message.to_bytes()
+        parsed = _parse_all(data)
+        # the last record's owner is a compression pointer in every sample
+        name_offset = _last_record_offset(data)
+        qname = message.questions[0].qname
+        yield label, [
+            ('DNSMessage.parse (header, question)', lambda: DNSMessage.parse(data)),
+            ('DNSMessage.parse (all sections)', lambda: _parse_all(data)),
+            ('DNSMessage.to_bytes', parsed.to_bytes),
+            ('DNSMessage.to_bytes (compress=False)', lambda: parsed.to_bytes(compress=False)),
+            ('parse_name (question)', lambda: parse_name(data, 12)),
+            ('parse_name (pointer)', lambda: parse_name(data, name_offset)),
+            ('encode_name', lambda: encode_name(qname)),
+            ('encode_name (compressed)', lambda: encode_name(qname, {}, 12)),
+        ]
+
+
+def main():
+    p = argparse.ArgumentParser(description='Microbenchmarks of DNS message parsing and serialization')
+    p.add_argument('--number', type=int, default=5000, help='Calls per measurement')
+    p.add_argument('--repeat', type=int, default=5, help='Measurements, the fastest one is reported')
+    args = p.parse_args()
+
+    for label, benchmarks in cases():
+        print(label)
+        for name, function in benchmarks:
+            best = min(timeit.repeat(function, number=args.number, repeat=args.repeat))
+            print('  {:<40} {:>10.2f} us'.format(name, best / args.number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
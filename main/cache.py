@@ -0,0 +1,192 @@
+import itertools
+import struct
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from main.messages import DNSHeader, DNSMessage, DNSQuestion, DNSRecord, QR, RA, RD
+from main.utils import parse_name
+from main.constants import *
+
+_TTL = struct.Struct('!I')
+_COUNTS = struct.Struct('!HHHHH')
+
+
+class LRUCache:
+    def __init__(self, max_size=10000, stale_window=0):
+        self._max_size = max_size
+        # expired entries are kept this many seconds longer for _get_stale
+        self._stale_window = stale_window
+        # key -> [expires_at, value, hits, stored_at, refreshed_from]
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refreshed_hits = 0
+
+    def _get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = entry[0], entry[1]
+        if expires_at <= now:
+            if expires_at + self._stale_window <= now:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        entry[2] += 1
+        if now >= entry[4]:
+            # the entry it replaced would have expired by now, this hit is thanks to the refresh
+            self.refreshed_hits += 1
+        return expires_at, value
+
+    def _put(self, key, expires_at, value, refresh=False):
+        if self._max_size <= 0:
+            return
+
+        refreshed_from = float('inf')
+        if refresh and key in self._entries:
+            refreshed_from = self._entries[key][0]
+        self._entries[key] = [expires_at, value, 0, time.time(), refreshed_from]
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _get_stale(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] + self._stale_window <= now:
+            return None
+        return entry[0], entry[1]
+
+    def due_for_refresh(self, min_hits, window) -> list:
+        # keys hit more than min_hits times that are in the last `window` fraction of their lifetime,
+        # their hit counters start over so they are picked once per lifetime
+        now = time.time()
+        due = []
+        for key, entry in self._entries.items():
+            expires_at, _, hits, stored_at, _ = entry
+            if hits > min_hits and now < expires_at and expires_at - now <= window * (expires_at - stored_at):
+                entry[2] = 0
+                due.append(key)
+        return due
+
+    def recent_keys(self, count) -> list:
+        # most recently used first
+        return list(itertools.islice(reversed(self._entries), count))
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'max_size': self._max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'refreshed_hits': self.refreshed_hits,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class AnswerCache(LRUCache):
+    @staticmethod
+    def _key(name: str, rtype: int) -> Tuple[str, int]:
+        return name.lower(), rtype
+
+    def get(self, name: str, rtype: int) -> Optional[List[DNSRecord]]:
+        now = time.time()
+        entry = self._get(self._key(name, rtype), now)
+        if entry is None:
+            return None
+
+        # hand out the remaining TTL, not the one the records were received with
+        expires_at, records = entry
+        remaining = int(expires_at - now)
+        return [
+            DNSRecord(r.rname, r.rtype, r.rclass, remaining, r.rdlength, r.rdata)
+            for r in records
+        ]
+
+    def put(self, name: str, rtype: int, records: List[DNSRecord], expires_at: Optional[float] = None):
+        if not records:
+            return
+
+        if expires_at is None:
+            expires_at = time.time() + min(r.ttl for r in records)
+
+        self._put(self._key(name, rtype), expires_at, list(records))
+
+    def get_stale(self, name: str, rtype: int, ttl: int) -> Optional[List[DNSRecord]]:
+        entry = self._get_stale(self._key(name, rtype), time.time())
+        if entry is None:
+            return None
+        return [DNSRecord(r.rname, r.rtype, r.rclass, ttl, r.rdlength, r.rdata) for r in entry[1]]
+
+
+class WireAnswerCache(LRUCache):
+    # Keeps the encoded answer section per (qname, qtype), laid out as if it followed a 12-byte
+    # header and the question, so its compression pointers stay valid for any client asking
+    # the same name. A hit only patches the ID, flags and TTLs into a copy of those bytes.
+
+    def put(self, question: DNSQuestion, answers: List[DNSRecord], refresh=False):
+        if not answers:
+            return
+
+        message = DNSMessage(DNSHeader(0, 0, 1, len(answers), 0, 0), [question], answers, [], [])
+        data = message.to_bytes()
+        question_end = 12 + len(question.to_bytes())
+
+        now = time.time()
+        ttl_offsets = []
+        expiries = []
+        i = question_end
+        for record in answers:
+            _, i = parse_name(data, i)
+            ttl_offsets.append(i + 4 - question_end)
+            expiries.append(now + record.ttl)
+            i += 10 + struct.unpack_from('!H', data, i + 8)[0]
+
+        self._put((question.qname.lower(), question.qtype), min(expiries),
+                  (len(answers), data[question_end:], ttl_offsets, expiries), refresh)
+
+    def get_response(self, request: bytes, qname: str, qtype: int, question_end: int) -> Optional[bytes]:
+        now = time.time()
+        entry = self._get((qname.lower(), qtype), now)
+        if entry is None:
+            return None
+
+        _, (ancount, answers, ttl_offsets, expiries) = entry
+        body = bytearray(answers)
+        for offset, expires_at in zip(ttl_offsets, expiries):
+            _TTL.pack_into(body, offset, max(0, int(expires_at - now)))
+
+        flags = (request[2] << 8 | request[3]) & RD | QR | RA | NOERROR
+        return request[:2] + _COUNTS.pack(flags, 1, ancount, 0, 0) + request[12:question_end] + body
+
+
+class NegativeCache(LRUCache):
+    # RFC 2308: NXDOMAIN is cached for the name, NODATA for (name, type)
+    NXDOMAIN = None
+
+    def get(self, name: str, rtype: int) -> Optional[int]:
+        # a live NXDOMAIN covers every type, an expired one doesn't hide a NODATA that is still valid
+        name = name.lower()
+        now = time.time()
+        nxdomain = self._entries.get((name, self.NXDOMAIN))
+        key = (name, self.NXDOMAIN) if nxdomain is not None and nxdomain[0] > now else (name, rtype)
+        entry = self._get(key, now)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def put_nxdomain(self, name: str, ttl: int):
+        self._put((name.lower(), self.NXDOMAIN), time.time() + ttl, NAMEERROR)
+
+    def put_nodata(self, name: str, rtype: int, ttl: int):
+        self._put((name.lower(), rtype), time.time() + ttl, NOERROR)
@@ -3,6 +3,10 @@ AAAA = 28
 NS = 2
 PTR = 12
 CNAME = 5
+SOA = 6
+OPT = 41
+
+TYPE_NAMES = {A: 'A', AAAA: 'AAAA', NS: 'NS', PTR: 'PTR', CNAME: 'CNAME', SOA: 'SOA', OPT: 'OPT'}
 
 
 NOERROR = 0
@@ -11,3 +15,6 @@ SERVERFAILURE = 2
 NAMEERROR = 3
 NOTIMPLEMENTED = 4
 REFUSED = 5
+
+RCODE_NAMES = {NOERROR: 'NOERROR', FORMATERROR: 'FORMERR', SERVERFAILURE: 'SERVFAIL', NAMEERROR: 'NXDOMAIN',
+               NOTIMPLEMENTED: 'NOTIMP', REFUSED: 'REFUSED'}
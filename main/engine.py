@@ -0,0 +1,827 @@
+import asyncio
+import contextvars
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Union
+from main.messages import DNSMessage, DNSRecord, DNSQuestion, AA, OPCODE
+from main.metrics import metrics
+from main.utils import parse_name
+from main.cache import AnswerCache, NegativeCache, WireAnswerCache
+from main.sharedcache import SharedAnswerCache
+from main.storage import CacheStorage, CacheWriteQueue
+from main.selection import ServerSelector
+from main.transport import UpstreamTransport
+from main.zonecuts import ZoneCutCache
+from main.hotset import read_names, write_names
+from main.singleflight import SingleFlight
+from main.constants import *
+
+# (qname, qtype, qclass) keys resolved further up the current lookup
+_resolution_chain = contextvars.ContextVar('resolution_chain', default=frozenset())
+
+
+class ResolutionEngine:
+    MAX_RECURSION = 10
+
+    def __init__(self, root_servers, cache_location, memory_cache_size=10000, cache_sweep_interval=60,
+                 cache_journal_mode='WAL', cache_synchronous='NORMAL',
+                 cache_write_batch_size=256, cache_write_flush_interval=1.0,
+                 query_timeout=10.0, stagger_delay=0.3, edns_buffer_size=1232,
+                 upstream_tcp_idle_timeout=10.0, upstream_tcp_max_lifetime=120.0, wire_cache_size=10000,
+                 shared_cache_location=None, shared_cache_slots=65536, shared_cache_slot_size=512,
+                 prefetch_min_hits=5, prefetch_window=0.1, prefetch_interval=1.0,
+                 serve_stale_window=0, stale_answer_deadline=1.8, stale_answer_ttl=30,
+                 negative_cache_size=10000, negative_cache_max_ttl=10800,
+                 upstream_min_timeout=0.2, upstream_max_timeout=5.0, upstream_port=53,
+                 warm_start_size=10000, hot_set_location=None, hot_set_size=1000, hot_set_interval=300,
+                 preload_names=None, preload_concurrency=20):
+        self._root_servers = [
+            ('.', ns)
+            for ns in root_servers
+        ]
+        self.cache = CacheStorage(cache_location, cache_journal_mode, cache_synchronous)
+        # commits and sweeps run on a thread and connection of their own, so the loop never waits for the disk
+        self.cache_writer = CacheStorage(cache_location, cache_journal_mode, cache_synchronous)
+        self._cache_writes = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cache-writer')
+        self.write_queue = CacheWriteQueue(cache_write_batch_size, cache_write_flush_interval)
+        self.answer_cache = AnswerCache(memory_cache_size, serve_stale_window)
+        self.wire_cache = WireAnswerCache(wire_cache_size)
+        self.negative_cache = NegativeCache(negative_cache_size)
+        self.zone_cuts = ZoneCutCache()
+        self.selector = ServerSelector(upstream_min_timeout, upstream_max_timeout)
+        self._glue_lookups = {}  # NS name -> task resolving its address
+        self.in_flight = 0
+        self.glue_resolved = 0
+        self.glue_failed = 0
+        self._negative_cache_max_ttl = negative_cache_max_ttl
+        self.shared_cache = None
+        if shared_cache_location:
+            self.shared_cache = SharedAnswerCache(shared_cache_location, shared_cache_slots, shared_cache_slot_size)
+        self._cache_sweep_interval = cache_sweep_interval
+        self._cache_write_flush_interval = cache_write_flush_interval
+        self._query_timeout = query_timeout
+        self._stagger_delay = stagger_delay
+        self.transport = UpstreamTransport(port=upstream_port,
+                                           edns_buffer_size=edns_buffer_size,
+                                           tcp_idle_timeout=upstream_tcp_idle_timeout,
+                                           tcp_max_lifetime=upstream_tcp_max_lifetime)
+        self._upstream_tcp_idle_timeout = upstream_tcp_idle_timeout
+        self.flights = SingleFlight()
+        self._serve_stale_window = serve_stale_window
+        self._stale_answer_deadline = stale_answer_deadline
+        self._stale_answer_ttl = stale_answer_ttl
+        self._refreshing = set()
+        self.stale_served = 0
+        self._prefetch_min_hits = prefetch_min_hits
+        self._prefetch_window = prefetch_window
+        self._prefetch_interval = prefetch_interval
+        self._prefetching = {}  # (qname, qtype) -> task
+        self.prefetch_started = 0
+        self.prefetch_refreshed = 0
+        self.prefetch_failed = 0
+        self._warm_start_size = min(warm_start_size, memory_cache_size)
+        self._hot_set_location = hot_set_location
+        self._hot_set_size = hot_set_size
+        self._hot_set_interval = hot_set_interval
+        self._preload_names = preload_names
+        self._preload_concurrency = preload_concurrency
+        self.warmed_answers = 0
+        self.warmed_delegations = 0
+        self.preload_resolved = 0
+        self.preload_failed = 0
+        self._tasks = []
+        self._loop = None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._init_cache()
+        self._warm_up()
+        self._tasks = [
+            asyncio.ensure_future(self._schedule(self._cleanup_cache, self._cache_sweep_interval)),
+            asyncio.ensure_future(self._schedule(self._flush_due_cache, self._cache_write_flush_interval)),
+            asyncio.ensure_future(self._schedule(self.transport.tcp_pool.evict, self._upstream_tcp_idle_timeout / 2)),
+        ]
+        if self._prefetch_window > 0:
+            self._tasks.append(asyncio.ensure_future(self._schedule(self._start_prefetch, self._prefetch_interval)))
+        if self._hot_set_location:
+            self._tasks.append(asyncio.ensure_future(self._schedule(self._save_hot_set, self._hot_set_interval)))
+        questions = self._questions_to_preload()
+        if questions:
+            self._tasks.append(asyncio.ensure_future(self._preload(questions)))
+
+    async def stop(self):
+        for task in self._tasks + list(self._prefetching.values()) + list(self._refreshing) + \
+                list(self._glue_lookups.values()):
+            task.cancel()
+        self._tasks = []
+        self.transport.close()
+        if self._hot_set_location:
+            self._save_hot_set()
+        self._flush_cache()
+        await self._loop.run_in_executor(self._cache_writes, self.cache_writer.close)
+        self._cache_writes.shutdown()
+        self.cache.close()
+        if self.shared_cache is not None:
+            self.shared_cache.close()
+
+    @staticmethod
+    async def _schedule(callback, interval):
+        while True:
+            await asyncio.sleep(interval)
+            result = callback()
+            if asyncio.iscoroutine(result):
+                await result
+
+    def _init_cache(self):
+        try:
+            self.cache.open()
+        except Exception as e:
+            logging.warning("Error with cache init: `{}`, will continue w/o it".format(e))
+
+        if self.shared_cache is not None:
+            try:
+                self.shared_cache.open()
+            except Exception as e:
+                logging.warning("Error with shared cache init: `{}`, will continue w/o it".format(e))
+
+    def _warm_up(self):
+        # loads what the cache file still holds into memory, so a restart doesn't begin with a cold cache
+        if self._warm_start_size <= 0:
+            return
+
+        started = time.monotonic()
+        now = int(time.time())
+        try:
+            delegations = []
+            for data, expires_at in self.cache.load_delegations(now):
+                record = DNSRecord.parse(data, 0)[0]
+                record.ttl = expires_at - now
+                delegations.append(record)
+            self._learn_zone_cuts(delegations)
+            self.warmed_delegations = len(delegations)
+
+            entries = self.cache.load_answers(now, self._warm_start_size)
+            # least recent first, so the most recent entries end up last to be evicted
+            for name, rtype, rows in reversed(entries):
+                records = []
+                for data, expires_at in rows:
+                    record = DNSRecord.parse(data, 0)[0]
+                    record.ttl = expires_at - now
+                    records.append(record)
+                self.answer_cache.put(name, rtype, records, expires_at=min(row[1] for row in rows))
+            self.warmed_answers = len(entries)
+        except Exception as e:
+            logging.warning("Error with cache warm up: `{}`, will continue w/o it".format(e))
+            return
+        logging.info('Warmed up `{}` answers and `{}` delegation records from cache in {:.2f}s'.format(
+            self.warmed_answers, self.warmed_delegations, time.monotonic() - started))
+
+    def _questions_to_preload(self) -> List[DNSQuestion]:
+        questions = []
+        for location in (self._hot_set_location, self._preload_names):
+            if not location:
+                continue
+            try:
+                questions += read_names(location)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logging.warning("Error with reading names to preload: `{}`, will continue w/o it".format(e))
+        unique = dict.fromkeys((name.lower(), rtype) for name, rtype in questions)
+        return [DNSQuestion(name, rtype, qclass=1) for name, rtype in unique]
+
+    async def _preload(self, questions: List[DNSQuestion]):
+        # answers from the warmed cache are cheap, everything else is resolved a few at a time
+        started = time.monotonic()
+        semaphore = asyncio.Semaphore(self._preload_concurrency)
+
+        async def preload(question):
+            async with semaphore:
+                try:
+                    result = await self.resolve_question(question)
+                except Exception as e:
+                    logging.debug('Error while preloading %s: [%s] %s', question, type(e), e)
+                    result = SERVERFAILURE
+            if isinstance(result, int):
+                self.preload_failed += 1
+                return
+            self.wire_cache.put(question, result)
+            self.preload_resolved += 1
+
+        await asyncio.gather(*[preload(question) for question in questions])
+        logging.info('Preloaded `{}` of `{}` names in {:.2f}s'.format(
+            self.preload_resolved, len(questions), time.monotonic() - started))
+
+    def _save_hot_set(self):
+        # the most recently answered questions, read back by the next start
+        keys = self.wire_cache.recent_keys(self._hot_set_size)
+        if not keys:
+            # nothing answered yet, keep the previous snapshot
+            return
+        try:
+            write_names(self._hot_set_location, keys)
+            logging.debug('Saved `%s` names of the hot set', len(keys))
+        except Exception as e:
+            logging.warning("Error with saving hot set: `{}`, will continue w/o it".format(e))
+
+    async def _cleanup_cache(self):
+        try:
+            # expired records stay around for the serve-stale window
+            changes = await self._loop.run_in_executor(self._cache_writes, self._sweep_cache,
+                                                       int(time.time()) - self._serve_stale_window)
+            changes += self.zone_cuts.prune()
+            changes += self.selector.prune()
+            logging.info("Cleared up `{}` entries from cache".format(changes))
+        except Exception as e:
+            logging.warning("Error with cache cleanup: `{}`, will continue w/o it".format(e))
+
+    def _sweep_cache(self, now) -> int:
+        self.cache_writer.open()
+        return self.cache_writer.sweep(now)
+
+    def _insert_cache(self, records: List[DNSRecord]):
+        try:
+            self.write_queue.add(records, int(time.time()))
+            logging.debug("Queued records `%s` for cache", records)
+        except Exception as e:
+            logging.warning("Error with cache insert: `{}`, will continue w/o it".format(e))
+        if self.write_queue.full():
+            self._flush_cache()
+
+    def _flush_cache(self):
+        batch = self.write_queue.take()
+        if batch is None:
+            return
+        future = self._loop.run_in_executor(self._cache_writes, self._write_cache, batch)
+        future.add_done_callback(lambda f: self._cache_written(batch, f))
+
+    def _write_cache(self, batch) -> int:
+        rows = CacheWriteQueue.rows(batch)
+        self.cache_writer.open()
+        self.cache_writer.insert_many(rows)
+        return len(rows)
+
+    def _cache_written(self, batch, future):
+        # until here lookups found the batch in the write queue
+        self.write_queue.done(batch)
+        try:
+            logging.debug("Saved `%s` records into cache", future.result())
+        except Exception as e:
+            logging.warning("Error with cache flush: `{}`, will continue w/o it".format(e))
+
+    def _share_answer(self, name, rtype, records, expires_at=None):
+        if self.shared_cache is None:
+            return
+        try:
+            self.shared_cache.put(name, rtype, records, expires_at)
+        except Exception as e:
+            logging.warning("Error with shared cache insert: `{}`, will continue w/o it".format(e))
+
+    def _flush_due_cache(self):
+        if self.write_queue.due():
+            self._flush_cache()
+
+    def _lookup_answer(self, question: DNSQuestion) -> List[DNSRecord]:
+        records = self.answer_cache.get(question.qname, question.qtype)
+        if records:
+            logging.debug('Got records `%s` from memory cache', records)
+            return records
+
+        if self.shared_cache is not None:
+            try:
+                records = self.shared_cache.get(question.qname, question.qtype)
+                if records:
+                    # records carry the remaining TTL by now
+                    self.answer_cache.put(question.qname, question.qtype, records)
+                    logging.debug('Got records `%s` from shared cache', records)
+                    return records
+            except Exception as e:
+                logging.warning("Error with shared cache lookup: `{}`, will continue w/o it".format(e))
+
+        try:
+            # fresh records may still wait for the writer
+            results = self.write_queue.lookup(question.qname, question.qtype, int(time.time())) or \
+                self.cache.lookup_answer(question.qname, question.qtype, int(time.time()))
+
+            if results:
+                now = int(time.time())
+                records = []
+                for data, expires_at in results:
+                    record = DNSRecord.parse(data, 0)[0]
+                    record.ttl = expires_at - now
+                    records.append(record)
+                expires_at = min(row[1] for row in results)
+                self.answer_cache.put(question.qname, question.qtype, records, expires_at=expires_at)
+                self._share_answer(question.qname, question.qtype, records, expires_at)
+                logging.debug('Got records `%s` from cache', records)
+                return records
+
+        except Exception as e:
+            logging.warning("Error with lookup answer: `{}`, will continue w/o it".format(e))
+
+    def _lookup_stale_answer(self, question: DNSQuestion) -> List[DNSRecord]:
+        if self._serve_stale_window <= 0:
+            return None
+
+        records = self.answer_cache.get_stale(question.qname, question.qtype, self._stale_answer_ttl)
+        if records:
+            return records
+
+        try:
+            # records still in the write queue are fresh, so _lookup_answer would have found them
+            results = self.cache.lookup_answer(question.qname, question.qtype,
+                                               int(time.time()) - self._serve_stale_window)
+            records = []
+            for data, _ in results:
+                record = DNSRecord.parse(data, 0)[0]
+                record.ttl = self._stale_answer_ttl
+                records.append(record)
+            return records
+        except Exception as e:
+            logging.warning("Error with lookup stale answer: `{}`, will continue w/o it".format(e))
+
+    def _lookup_delegates(self, qname):
+        try:
+            # delegations still in the write queue are in the zone cuts too, which are asked first
+            now = int(time.time())
+            results = self.cache.lookup_delegates(qname, now)
+
+            if results:
+                records = []
+                for data, expires_at in results:
+                    delegate = DNSRecord.parse(data, 0)[0]
+                    records.append((delegate.rname, delegate.as_ip()))
+                    # warm the zone cuts, so the next lookups under this zone stay in memory
+                    self.zone_cuts.add_delegation(qname, delegate.rname, expires_at - now)
+                    self.zone_cuts.add_address(delegate.rname, delegate.as_ip(), expires_at - now)
+                logging.debug('Got delegates `%s` from cache', records)
+                return records
+
+        except Exception as e:
+            logging.warning("Error with lookup delegate: `{}`, will continue w/o it".format(e))
+
+    async def collect_stats(self) -> dict:
+        return self.stats()
+
+    def stats_threadsafe(self, timeout=5.0) -> dict:
+        # stats() walks dicts the loop keeps changing, so other threads have it run on the loop
+        if self._loop is None:
+            return {}
+        return asyncio.run_coroutine_threadsafe(self.collect_stats(), self._loop).result(timeout)
+
+    def stats(self) -> dict:
+        return {
+            'answer_cache': self.answer_cache.stats(),
+            'wire_cache': self.wire_cache.stats(),
+            'negative_cache': self.negative_cache.stats(),
+            'zone_cuts': self.zone_cuts.stats(),
+            'queries': {'in_flight': self.in_flight},
+            'warm_start': {
+                'answers': self.warmed_answers,
+                'delegation_records': self.warmed_delegations,
+                'preload_resolved': self.preload_resolved,
+                'preload_failed': self.preload_failed,
+            },
+            'upstream_servers': self.selector.stats(),
+            'glue_lookups': {
+                'in_flight': len(self._glue_lookups),
+                'resolved': self.glue_resolved,
+                'failed': self.glue_failed,
+            },
+            'shared_cache': self.shared_cache.stats() if self.shared_cache is not None else {},
+            'upstream_tcp_pool': self.transport.tcp_pool.stats(),
+            'single_flight': self.flights.stats(),
+            'serve_stale': {
+                'served': self.stale_served,
+                'refreshing': len(self._refreshing),
+            },
+            'prefetch': {
+                'in_flight': len(self._prefetching),
+                'started': self.prefetch_started,
+                'refreshed': self.prefetch_refreshed,
+                'failed': self.prefetch_failed,
+                'saved_misses': self.wire_cache.refreshed_hits,
+            },
+        }
+
+    def cached_response(self, data: bytes) -> Optional[bytes]:
+        # served straight from the encoded answers, no records or messages are built on a hit;
+        # only standard queries (QR and opcode 0) of class IN, the rest takes the slow path
+        if len(data) < 17 or data[2] & 0xF8 or data[4:6] != b'\x00\x01':
+            return None
+        try:
+            qname, i = parse_name(data, 12)
+        except Exception:
+            return None
+        if i + 4 > len(data) or data[i + 2:i + 4] != b'\x00\x01':
+            return None
+
+        qtype = data[i] << 8 | data[i + 1]
+        started = time.perf_counter()
+        response = self.wire_cache.get_response(data, qname, qtype, i + 4)
+        if response is None:
+            metrics.inc('cache_lookups', cache='wire', result='miss')
+            return None
+
+        metrics.observe('query_seconds', time.perf_counter() - started, path='wire_cache')
+        metrics.inc('cache_lookups', cache='wire', result='hit')
+        metrics.inc('responses', qtype=TYPE_NAMES.get(qtype, qtype), rcode='NOERROR')
+        return response
+
+    async def resolve(self, data: bytes) -> bytes:
+        response = self.cached_response(data)
+        if response is not None:
+            logging.debug('Answered %s from wire cache', data[:2])
+            return response
+        return await self.resolve_uncached(data)
+
+    async def resolve_uncached(self, data: bytes) -> bytes:
+        # for callers that tried cached_response() already, so a miss is counted once
+        started = time.perf_counter()
+        self.in_flight += 1
+        try:
+            request, response = await self._resolve(data)
+        finally:
+            self.in_flight -= 1
+
+        metrics.observe('query_seconds', time.perf_counter() - started, path='resolve')
+        qtype = request.questions[0].qtype if request.questions else None
+        metrics.inc('responses', qtype=TYPE_NAMES.get(qtype, qtype), rcode=RCODE_NAMES.get(response[3] & 0xF))
+        return response
+
+    @staticmethod
+    def _to_bytes(message: DNSMessage) -> bytes:
+        with metrics.timer('stage_seconds', stage='serialize'):
+            return message.to_bytes()
+
+    async def _resolve(self, data: bytes):
+        with metrics.timer('stage_seconds', stage='parse'):
+            request, _ = DNSMessage.parse(data)
+        if len(request.questions) != 1:
+            return request, self._to_bytes(request.with_rcode(NOTIMPLEMENTED).as_response())
+
+        if request.questions[0].qtype not in {A, AAAA, PTR, NS}:
+            return request, self._to_bytes(request.with_rcode(NOTIMPLEMENTED).as_response())
+
+        # the caches only hold IN answers to standard queries
+        if request.header.flags & OPCODE or request.questions[0].qclass != 1:
+            return request, self._to_bytes(request.with_rcode(NOTIMPLEMENTED).as_response())
+
+        request.header.ancount = 0
+        request.header.arcount = 0
+        request.header.nscount = 0
+        request.answers = []
+        request.additionals = []
+        request.authorities = []
+
+        question = request.questions[0]
+        resolution = asyncio.ensure_future(asyncio.wait_for(self.resolve_question(question), self._query_timeout))
+        try:
+            if self._serve_stale_window > 0:
+                # past the client-facing deadline a stale answer beats waiting out a slow or dead upstream
+                await asyncio.wait({resolution}, timeout=self._stale_answer_deadline)
+                if not resolution.done():
+                    stale = self._lookup_stale_answer(question)
+                    if stale:
+                        logging.info('{} is taking longer than {}s, answering stale records'.format(
+                            question, self._stale_answer_deadline))
+                        self._refresh_in_background(resolution)
+                        return request, self._stale_response(request, stale)
+            result = await resolution
+        except asyncio.TimeoutError:
+            logging.info('Resolving {} exceeded the {}s deadline, giving up'.format(request.questions[0],
+                                                                                   self._query_timeout))
+            result = SERVERFAILURE
+        except Exception as e:
+            logging.error('Exception during resolving: [{}] {}'.format(type(e), e))
+            return request, self._to_bytes(request.with_rcode(SERVERFAILURE).as_response())
+
+        if isinstance(result, int) and result in {SERVERFAILURE, REFUSED}:
+            stale = self._lookup_stale_answer(question)
+            if stale:
+                logging.info('Resolving {} failed with {}, answering stale records'.format(question, result))
+                return request, self._stale_response(request, stale)
+
+        if isinstance(result, int):
+            if result != NOERROR:
+                logging.debug('A problem occurred during resolving, giving up: %s', result)
+            return request, self._to_bytes(request.with_AA(is_authoritative=False)
+                                                  .with_RA(is_available=True)
+                                                  .with_rcode(result)
+                                                  .as_response())
+
+        # there might be an answer
+        self.wire_cache.put(request.questions[0], result)
+        request.answers = result
+        request.header.ancount = len(result)
+        logging.debug('Got %s answers: %s', len(result), result)
+        return request, self._to_bytes(request.with_AA(is_authoritative=False)
+                                              .with_RA(is_available=True)
+                                              .with_rcode(NOERROR)
+                                              .as_response())
+
+    def _refresh_in_background(self, resolution):
+        # the client already got a stale answer, the resolution keeps going and refreshes the cache
+        self._refreshing.add(resolution)
+
+        def done(task):
+            self._refreshing.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                logging.info('Background refresh failed: [{}] {}'.format(type(task.exception()), task.exception()))
+        resolution.add_done_callback(done)
+
+    def _stale_response(self, request: DNSMessage, records: List[DNSRecord]) -> bytes:
+        self.stale_served += 1
+        request.answers = records
+        request.header.ancount = len(records)
+        return self._to_bytes(request.with_AA(is_authoritative=False)
+                                     .with_RA(is_available=True)
+                                     .with_rcode(NOERROR)
+                                     .as_response())
+
+    def _start_prefetch(self):
+        # popular answers close to expiry are resolved again in the background, so clients keep hitting
+        for qname, qtype in self.wire_cache.due_for_refresh(self._prefetch_min_hits, self._prefetch_window):
+            if (qname, qtype) in self._prefetching:
+                continue
+            task = asyncio.ensure_future(self._prefetch(DNSQuestion(qname, qtype, qclass=1)))
+            self._prefetching[(qname, qtype)] = task
+            task.add_done_callback(lambda _, key=(qname, qtype): self._prefetching.pop(key, None))
+            self.prefetch_started += 1
+
+    async def _prefetch(self, question: DNSQuestion):
+        logging.debug('Prefetching {}'.format(question))
+        try:
+            key = (question.qname, question.qtype, question.qclass)
+            result = await self.flights.do(('prefetch',) + key, lambda: asyncio.wait_for(
+                self._resolve_question(question, 0, frozenset({key}), use_cache=False), self._query_timeout))
+        except Exception as e:
+            logging.warning('Error while prefetching {}: [{}] {}'.format(question, type(e), e))
+            result = SERVERFAILURE
+
+        if isinstance(result, int):
+            self.prefetch_failed += 1
+            return
+        self.wire_cache.put(question, result, refresh=True)
+        self.prefetch_refreshed += 1
+
+    async def resolve_question(self, question: DNSQuestion, recursion_lvl=0) -> Union[int, List[DNSRecord]]:
+        key = (question.qname.lower(), question.qtype, question.qclass)
+        chain = _resolution_chain.get()
+        if key in chain:
+            # e.g. a glue-less NS inside the zone it serves, joining our own flight would deadlock
+            logging.info('{} is already being resolved up the chain, giving up'.format(question))
+            return SERVERFAILURE
+
+        # concurrent lookups of the same question share one upstream resolution
+        return await self.flights.do(key, lambda: asyncio.wait_for(
+            self._resolve_question(question, recursion_lvl, chain | {key}), self._query_timeout))
+
+    async def _resolve_question(self, question: DNSQuestion, recursion_lvl, chain, use_cache=True):
+        _resolution_chain.set(chain)
+        for _ in range(self.MAX_RECURSION):
+            result = await self.answer(question, recursion_lvl, use_cache)
+            if isinstance(result, int):
+                if result == NOERROR:
+                    # found new delegates, continue
+                    continue
+                if result in {NAMEERROR, REFUSED, SERVERFAILURE}:
+                    return result
+                raise Exception('Unknown int result: {}'.format(result))
+            return result
+        return NOERROR
+
+    def where_to_ask(self, qname):
+        cut = self.zone_cuts.find(qname)
+        zone = cut[0] if cut is not None else '.'
+
+        # the SQLite cache may know cuts below the deepest one in memory, e.g. right after a restart
+        labels = [label for label in qname.split('.') if label]
+        depth = len([label for label in zone.split('.') if label])
+        for k in range(len(labels) - depth):  # ['some.example.com.', 'example.com.'] below 'com.'
+            delegates = self._lookup_delegates('.'.join(labels[k:]) + '.')
+            if delegates:
+                # find NS servers of the zone
+                return delegates
+
+        if cut is not None:
+            logging.debug('Got delegates `%s` of `%s` from zone cuts', cut[1], zone)
+            return cut[1]
+
+        # ask root servers
+        return list(self._root_servers)
+
+    async def fill_missing_ns(self, response, recursion_lvl):
+        # glue-less nameservers are looked up concurrently, the referral is followed as soon as one
+        # of them has an address and the rest keep resolving in the background
+        if recursion_lvl == 5:
+            return
+
+        chain = _resolution_chain.get()
+        for zone in {a.rname.lower() for a in response.authorities if a.rtype == NS}:
+            lookups = [
+                self._resolve_nameserver(nameserver, recursion_lvl)
+                for nameserver in self.zone_cuts.missing_addresses(zone)
+                if (nameserver, A, 1) not in chain
+            ]
+            pending = set(lookups)
+            while pending and not self.zone_cuts.servers(zone):
+                _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+    def _resolve_nameserver(self, nameserver, recursion_lvl) -> asyncio.Future:
+        task = self._glue_lookups.get(nameserver)
+        if task is None:
+            logging.debug('Trying to resolve NS server: %s', nameserver)
+            task = asyncio.ensure_future(self._lookup_nameserver(nameserver, recursion_lvl))
+            self._glue_lookups[nameserver] = task
+            task.add_done_callback(lambda _: self._glue_lookups.pop(nameserver, None))
+        return task
+
+    async def _lookup_nameserver(self, nameserver, recursion_lvl):
+        try:
+            result = await self.resolve_question(DNSQuestion(nameserver, A, qclass=1), recursion_lvl + 1)
+        except Exception as e:
+            logging.warning('Error while resolving NS server {}: [{}] {}'.format(nameserver, type(e), e))
+            result = SERVERFAILURE
+
+        addresses = [r for r in result if r.rtype == A] if not isinstance(result, int) else []
+        if not addresses:
+            # don't chase it again on every referral for a while
+            self.zone_cuts.mark_unresolvable(nameserver)
+            self.glue_failed += 1
+        else:
+            # answers from the caches never went through probe(), so the zone cuts learn them here
+            for r in addresses:
+                self.zone_cuts.add_address(nameserver, r.as_ip(), r.ttl)
+            self.glue_resolved += 1
+
+    async def answer(self, question: DNSQuestion, recursion_lvl=0, use_cache=True) -> Union[int, List[DNSRecord]]:
+        if use_cache:
+            with metrics.timer('stage_seconds', stage='cache_lookup'):
+                cached = self._lookup_answer(question)
+            metrics.inc('cache_lookups', cache='answers', result='hit' if cached else 'miss')
+            if cached:
+                return cached
+
+            negative = self.negative_cache.get(question.qname, question.qtype)
+            metrics.inc('cache_lookups', cache='negative', result='miss' if negative is None else 'hit')
+            if negative is not None:
+                logging.debug('Got negative answer %s for %s from cache', negative, question)
+                return NAMEERROR if negative == NAMEERROR else []
+
+        with metrics.timer('stage_seconds', stage='delegate_lookup'):
+            servers = self.selector.order(self.where_to_ask(question.qname))
+        response, failure = await self.probe_staggered(question, servers)
+        if response is None:
+            return failure
+
+        if response.header.rcode() == NAMEERROR:
+            self._cache_negative(question, response, NAMEERROR)
+            return NAMEERROR
+        if response.answers:
+            self.answer_cache.put(question.qname, question.qtype, response.answers)
+            self._share_answer(question.qname, question.qtype, response.answers)
+            return response.answers
+        if response.header.flags & AA or any(a.rtype == SOA for a in response.authorities) or \
+                not any(a.rtype == NS for a in response.authorities):
+            # the zone itself answered (a SOA or AA, the zone's NS records may come along), or there is no
+            # referral: the name exists but has no records of this type
+            self._cache_negative(question, response, NOERROR)
+            return []
+        await self.fill_missing_ns(response, recursion_lvl)
+        return NOERROR
+
+    def _cache_negative(self, question: DNSQuestion, response: DNSMessage, rcode):
+        # RFC 2308: negative answers live as long as the SOA's TTL and minimum allow, without a SOA not at all
+        soa = [a for a in response.authorities if a.rtype == SOA]
+        if not soa:
+            return
+
+        ttl = min(soa[0].ttl, soa[0].soa_minimum(), self._negative_cache_max_ttl)
+        if rcode == NAMEERROR:
+            self.negative_cache.put_nxdomain(question.qname, ttl)
+        else:
+            self.negative_cache.put_nodata(question.qname, question.qtype, ttl)
+
+    async def _probe_usable(self, question: DNSQuestion, server):
+        # (response, None) if usable, (None, rcode) if the server failed, (None, None) if it didn't answer
+        try:
+            response = await self.probe(DNSMessage.from_question(question), server)
+        except Exception as e:
+            logging.debug('Error while talking to %s: [%s] %s', server, type(e), e)
+            return None, None
+
+        rcode = response.header.rcode()
+        if rcode == NAMEERROR or (rcode == NOERROR and (response.answers or response.authorities)):
+            return response, None
+        # anything else, e.g. SERVFAIL, FORMERR or a lame empty answer, is the server's failure, not the name's
+        return None, REFUSED if rcode == REFUSED else SERVERFAILURE
+
+    async def probe_staggered(self, question: DNSQuestion, ns_servers):
+        # ask the next server whenever the previous ones fail or stay silent for stagger_delay,
+        # the first usable response wins and the rest are cancelled. Once every server was asked,
+        # the ones that didn't answer are asked again after a pause that doubles each round, until
+        # the query deadline, so a lost datagram doesn't fail the query
+        servers = list(ns_servers)
+        queue = list(servers)
+        pending = {}  # task -> server
+        failed = set()  # servers that answered with a failure, not asked again
+        failures = []
+        backoff = self._stagger_delay
+        retry_at = None
+        deadline = time.monotonic() + self._query_timeout
+        try:
+            while True:
+                if not queue and retry_at is not None and time.monotonic() >= retry_at:
+                    queue = self.selector.order([s for s in servers if s not in failed])
+                    retry_at = None
+                if queue:
+                    server = queue.pop(0)
+                    pending[asyncio.ensure_future(self._probe_usable(question, server))] = server
+                    if not queue:
+                        retry_at = time.monotonic() + backoff
+                        backoff *= 2
+
+                if queue:
+                    timeout = self._stagger_delay
+                elif retry_at is not None and retry_at < deadline and len(failed) < len(servers):
+                    timeout = max(0.0, retry_at - time.monotonic())
+                elif pending:
+                    timeout = None
+                else:
+                    break
+
+                if not pending:
+                    await asyncio.sleep(timeout)
+                    continue
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    server = pending.pop(task)
+                    response, failure = task.result()
+                    if response is not None:
+                        return response, None
+                    if failure is not None:
+                        failed.add(server)
+                    failures.append(failure or SERVERFAILURE)
+        finally:
+            for task in pending:
+                task.cancel()
+
+        for failure in [SERVERFAILURE, REFUSED]:
+            if failure in failures:
+                return None, failure
+        return None, NAMEERROR
+
+    def _learn_zone_cuts(self, records: List[DNSRecord]):
+        for r in records:
+            if r.rtype == NS:
+                self.zone_cuts.add_delegation(r.rname, r.rdata.decode('latin-1'), r.ttl)
+        for r in records:
+            if r.rtype in {A, AAAA} and self.zone_cuts.is_nameserver(r.rname):
+                self.zone_cuts.add_address(r.rname, r.as_ip(), r.ttl)
+
+    async def probe(self, request, server):
+        # non recursive
+        request = request.with_RD(is_desired=False)
+        ip = server[-1]
+        started = time.monotonic()
+        try:
+            resp_data = await self.transport.query(request, ip, timeout=self.selector.timeout(ip))
+        except asyncio.TimeoutError:
+            self.selector.record_failure(ip)
+            metrics.inc('upstream_queries', result='timeout')
+            raise
+        except (OSError, ConnectionError):
+            self.selector.record_failure(ip, timed_out=False)
+            metrics.inc('upstream_queries', result='error')
+            raise
+        except asyncio.CancelledError:
+            # outrun by another server or the deadline, the answer takes at least this long
+            self.selector.record_lower_bound(ip, time.monotonic() - started)
+            metrics.inc('upstream_queries', result='cancelled')
+            raise
+        rtt = time.monotonic() - started
+        self.selector.record_rtt(ip, rtt)
+        metrics.inc('upstream_queries', result='ok')
+        metrics.observe('upstream_seconds', rtt)
+
+        logging.debug('Sent request to %s: %s', server, request)
+
+        response = DNSMessage.parse(resp_data)[0]
+
+        logging.debug('Response from %s: %s', server, response)
+
+        records = [r for r in response.records() if r.rtype != OPT]
+        self._insert_cache(records)
+        self._learn_zone_cuts(records)
+
+        rrsets = {}
+        for r in records:
+            rrsets.setdefault((r.rname.lower(), r.rtype), []).append(r)
+
+        for (name, rtype), records in rrsets.items():
+            self.answer_cache.put(name, rtype, records)
+            self._share_answer(name, rtype, records)
+
+        return response
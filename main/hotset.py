@@ -0,0 +1,35 @@
+import logging
+import os
+from typing import Iterable, List, Tuple
+from main.constants import *
+
+_TYPES = {name: rtype for rtype, name in TYPE_NAMES.items()}
+
+
+def read_names(location) -> List[Tuple[str, int]]:
+    # one `name [type]` per line, type A if left out, `#` starts a comment
+    questions = []
+    with open(location) as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            name = fields[0] if fields[0].endswith('.') else fields[0] + '.'
+            rtype = fields[1].upper() if len(fields) > 1 else 'A'
+            if rtype.isdigit():
+                questions.append((name, int(rtype)))
+            elif rtype in _TYPES:
+                questions.append((name, _TYPES[rtype]))
+            else:
+                logging.warning('Unknown type `{}` for `{}` in {}, skipping'.format(rtype, name, location))
+    return questions
+
+
+def write_names(location, questions: Iterable[Tuple[str, int]]) -> int:
+    # written next to the old file and renamed over it, so readers never see half a snapshot
+    lines = ['{} {}\n'.format(name, TYPE_NAMES.get(rtype, rtype)) for name, rtype in questions]
+    temporary = '{}.{}.tmp'.format(location, os.getpid())
+    with open(temporary, 'w') as f:
+        f.writelines(lines)
+    os.replace(temporary, location)
+    return len(lines)
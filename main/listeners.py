@@ -1,17 +1,27 @@
+import queue
+import select
 import socket
+import sys
+import threading
 from pykka import ThreadingActor
 from abc import abstractmethod
 from main.utils import recv_tcp_message, send_tcp_message
-from main.messages import DNSMessage
+from main.messages import truncate_response
+from main.metrics import metrics
 import logging
+import struct
+
+# from linux/socket.h, the socket module doesn't export it
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40 if sys.platform.startswith('linux') else None)
 
 
 class BaseListener(ThreadingActor):
-    def __init__(self, host, port, resolver_ref):
+    def __init__(self, host, port, resolver_ref, reuse_port=False):
         super().__init__()
         self._host = host
         self._port = port
         self._resolver_ref = resolver_ref
+        self._reuse_port = reuse_port
         self._socket = None
 
     def on_receive(self, message):
@@ -40,6 +50,12 @@ class BaseListener(ThreadingActor):
     def open(self):
         pass
 
+    def _bind(self):
+        if self._reuse_port:
+            # every worker process binds the same address, the kernel spreads clients across them
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._socket.bind((self._host, self._port))
+
     @abstractmethod
     def produce(self):
         pass
@@ -55,46 +71,224 @@ class BaseListener(ThreadingActor):
 
 
 class UDPListener(BaseListener):
+    # Drains the socket in batches into preallocated buffers and hands each batch to the resolver at
+    # once: cache hits come back as responses, misses as futures answered from the resolver's loop.
+    # Python has no recvmmsg/sendmmsg, so a batch still costs one syscall per datagram.
+    MAX_QUERY_SIZE = 4096
+
+    def __init__(self, host, port, resolver_ref, reuse_port=False, batch_size=64, rcvbuf=0, max_pending=10000):
+        super().__init__(host, port, resolver_ref, reuse_port)
+        self._buffers = [bytearray(self.MAX_QUERY_SIZE) for _ in range(max(1, batch_size))]
+        self._rcvbuf = rcvbuf
+        self._max_pending = max_pending
+        self._submitted = 0
+        self._answered = 0  # only counted on the resolver's loop
+        self._ancillary_size = 0
+        self._kernel_drops = 0
+        self._poll = None
+
     def open(self):
         logging.info('[{}] opening socket'.format(self.__class__.__name__))
         self._socket = socket.socket(socket.AF_INET,     # Internet
                                      socket.SOCK_DGRAM)  # UDP
-        self._socket.settimeout(5)
-        self._socket.bind((self._host, self._port))
+        # non-blocking, produce waits in poll() once per batch and then drains what is queued
+        self._socket.setblocking(False)
+        self._poll = select.poll()
+        self._poll.register(self._socket, select.POLLIN)
+        if self._rcvbuf:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._rcvbuf)
+            logging.info('[{}] receive buffer is {} bytes'.format(
+                self.__class__.__name__, self._socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)))
+        try:
+            # Linux passes the number of datagrams dropped for a full receive buffer along with each one
+            if SO_RXQ_OVFL is None:
+                raise OSError('not supported on {}'.format(sys.platform))
+            self._socket.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+            self._ancillary_size = socket.CMSG_SPACE(4)
+        except OSError as e:
+            logging.warning("Error with kernel drop counter: `{}`, will continue w/o it".format(e))
+        self._bind()
+
+    def _receive(self, buffer):
+        size, ancillary, _, addr = self._socket.recvmsg_into([buffer], self._ancillary_size)
+        for level, kind, data in ancillary:
+            if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL and len(data) >= 4:
+                dropped = struct.unpack('=I', data[:4])[0]
+                if dropped != self._kernel_drops:
+                    metrics.inc('udp_dropped', (dropped - self._kernel_drops) & 0xFFFFFFFF, reason='kernel')
+                    self._kernel_drops = dropped
+        return bytes(buffer[:size]), addr
 
     def produce(self):
-        data, addr = self._socket.recvfrom(2 ** 16)
-        logging.debug('[{}] received data from `{}`: {}'.format(self.__class__.__name__, addr, data))
+        if not self._poll.poll(5000):
+            raise socket.timeout()
+        batch = []
+        try:
+            for buffer in self._buffers:
+                batch.append(self._receive(buffer))
+        except BlockingIOError:
+            if not batch:
+                return
+        metrics.inc('udp_received', len(batch))
+        logging.debug('[%s] received %s datagrams', self.__class__.__name__, len(batch))
+
+        # misses are answered from the resolver's loop once ready, so a slow lookup doesn't hold up other clients
+        results = self._resolver_ref.ask({'command': 'submit_batch',
+                                          'data': [data for data, _ in batch],
+                                          'limit': self._max_pending - (self._submitted - self._answered)})
+        for (_, addr), result in zip(batch, results):
+            if result is None:
+                metrics.inc('udp_dropped', reason='overload')
+            elif isinstance(result, bytes):
+                self.send(result, addr)
+            else:
+                self._submitted += 1
+                result.add_done_callback(lambda f, addr=addr: self.respond(f, addr))
+
+    def respond(self, future, addr):
+        self._answered += 1
+        try:
+            response = future.result()
+        except Exception as e:
+            logging.error('[{}] unhandled exception: {}'.format(self.__class__.__name__, e))
+            return
+        self.send(response, addr)
+
+    def send(self, response, addr):
+        try:
+            logging.debug('[%s] response is: %s', self.__class__.__name__, response)
+            if len(response) > 512:
+                logging.debug('UDP response is `%s` bytes length, truncating', len(response))
+                response = truncate_response(response)
+
+            with metrics.timer('stage_seconds', stage='send'):
+                self._socket.sendto(response, addr)
+        except BlockingIOError:
+            # the socket is non-blocking, a full send buffer drops the answer like the network would
+            metrics.inc('udp_dropped', reason='send')
+        except Exception as e:
+            logging.error('[{}] unhandled exception: {}'.format(self.__class__.__name__, e))
+
+
+class TCPConnection:
+    # One client connection (RFC 7766): queries are read and handed to the resolver as they arrive and
+    # answers are written back by a second thread in the order they complete, so a slow answer doesn't
+    # hold up the ones behind it. The connection is closed once the client goes idle or hangs up.
+    MESSAGE_TIMEOUT = 10.0  # seconds a client gets to finish a message once it started sending it
+
+    def __init__(self, conn, addr, resolver_ref, idle_timeout, max_pipelined, on_close):
+        self._conn = conn
+        self._addr = addr
+        self._resolver_ref = resolver_ref
+        self._on_close = on_close
+        self._responses = queue.Queue()
+        self._slots = threading.Semaphore(max_pipelined)
+        self._submitted = 0
+        self._answered = 0
+        conn.settimeout(idle_timeout)
+
+    def start(self):
+        threading.Thread(target=self._read, daemon=True).start()
+        threading.Thread(target=self._write, daemon=True).start()
+
+    def _read(self):
+        try:
+            while True:
+                try:
+                    data = recv_tcp_message(self._conn, self.MESSAGE_TIMEOUT)
+                except socket.timeout:
+                    if self._submitted > self._answered:
+                        # not idle while the client waits for answers
+                        continue
+                    logging.debug('[%s] %s idle, closing', self.__class__.__name__, self._addr)
+                    metrics.inc('tcp_connections_closed', reason='idle')
+                    break
+                if not data:
+                    break
+                logging.debug('[%s] received data: %s', self.__class__.__name__, data)
 
-        response = self._resolver_ref.ask({'command': 'resolve', 'data': data})
-        logging.debug('[{}] response is: {}'.format(self.__class__.__name__, response))
+                self._slots.acquire()
+                self._submitted += 1
+                future = self._resolver_ref.ask({'command': 'submit', 'data': data})
+                future.add_done_callback(self._responses.put)
+        except (ConnectionError, OSError) as e:
+            logging.debug('[%s] %s: %s', self.__class__.__name__, self._addr, e)
+        finally:
+            # no more queries, the writer finishes the pending ones
+            self._responses.put(None)
+
+    def _write(self):
+        reading = True
+        broken = False
+        while reading or self._answered < self._submitted:
+            future = self._responses.get()
+            if future is None:
+                reading = False
+                continue
 
-        if len(response) > 512:
-            logging.info('UDP response is `{}` bytes length, truncating'.format(len(response)))
-            response = DNSMessage.parse(response)[0]
-            response.with_TC(is_truncated=True)
-            response = response.to_bytes()[:512]
+            self._answered += 1
+            self._slots.release()
+            if broken:
+                continue
+            try:
+                response = future.result()
+                logging.debug('[%s] response is: %s', self.__class__.__name__, response)
+                with metrics.timer('stage_seconds', stage='send'):
+                    send_tcp_message(self._conn, response)
+            except (ConnectionError, OSError) as e:
+                # the reader sees the connection end too
+                logging.debug('[%s] %s: %s', self.__class__.__name__, self._addr, e)
+                broken = True
+                self.shutdown()
+            except Exception as e:
+                logging.error('[{}] unhandled exception: {}'.format(self.__class__.__name__, e))
 
-        self._socket.sendto(response, addr)
+        self._conn.close()
+        self._on_close(self)
+        logging.debug('[%s] %s disconnected', self.__class__.__name__, self._addr)
+
+    def shutdown(self):
+        try:
+            self._conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
 
 class TCPListener(BaseListener):
+    def __init__(self, host, port, resolver_ref, reuse_port=False, idle_timeout=10.0, max_connections=256,
+                 max_pipelined=32):
+        super().__init__(host, port, resolver_ref, reuse_port)
+        self._idle_timeout = idle_timeout
+        self._max_connections = max_connections
+        self._max_pipelined = max_pipelined
+        self._connections = set()
+
     def open(self):
         logging.info('[{}] opening socket'.format(self.__class__.__name__))
         self._socket = socket.socket(socket.AF_INET,      # Internet
                                      socket.SOCK_STREAM)  # TCP
         self._socket.settimeout(5)
-        self._socket.bind((self._host, self._port))
+        # connections closed by us on idle leave the port in TIME_WAIT for a while
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._bind()
         self._socket.listen()
 
     def produce(self):
         conn, addr = self._socket.accept()
-        with conn:
-            logging.debug('[{}] connected by {}'.format(self.__class__.__name__, addr))
-            data = recv_tcp_message(conn)
-            logging.debug('[{}] received data: {}'.format(self.__class__.__name__, data))
-
-            response = self._resolver_ref.ask({'command': 'resolve', 'data': data})
-            logging.debug('[{}] response is: {}'.format(self.__class__.__name__, response))
-            send_tcp_message(conn, response)
-        logging.debug('[{}] {} disconnected'.format(self.__class__.__name__, addr))
+        if len(self._connections) >= self._max_connections:
+            logging.debug('[%s] %s connections open, refusing %s', self.__class__.__name__,
+                          len(self._connections), addr)
+            metrics.inc('tcp_connections_closed', reason='limit')
+            conn.close()
+            return
+
+        logging.debug('[{}] connected by {}'.format(self.__class__.__name__, addr))
+        connection = TCPConnection(conn, addr, self._resolver_ref, self._idle_timeout, self._max_pipelined,
+                                   self._connections.discard)
+        self._connections.add(connection)
+        connection.start()
+
+    def close(self):
+        for connection in list(self._connections):
+            connection.shutdown()
+        super().close()
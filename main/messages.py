@@ -1,16 +1,36 @@
 import dataclasses
 from typing import List, Optional
 from main.utils import *
-from copy import deepcopy
 from main.constants import *
 import ipaddr
-import random
+import secrets
+
+
+# header flag bits
+QR = 0x8000
+OPCODE = 0x7800
+AA = 0x0400
+TC = 0x0200
+RD = 0x0100
+RA = 0x0080
+RCODE = 0x000F
+
+# types whose RDATA is a single domain name, kept decoded and compressed on output
+NAME_TYPES = {NS, CNAME, PTR}
+# types whose RDATA holds names that may be compressed in received messages
+COMPRESSED_TYPES = NAME_TYPES | {SOA}
+
+_HEADER = struct.Struct('!HHHHHH')
+_QUESTION_TAIL = struct.Struct('!HH')
+_RECORD_TAIL = struct.Struct('!HHIH')
+# a record whose owner is a compression pointer
+_POINTER_RECORD = struct.Struct('!HHHIH')
 
 
 @dataclasses.dataclass
 class DNSHeader:
     id: int
-    flags: str
+    flags: int
     qdcount: int
     ancount: int
     nscount: int
@@ -18,16 +38,13 @@ class DNSHeader:
 
     @staticmethod
     def parse(data, i):
-        id, flags, questions_count, answers_count, authority_count, additional_count = struct.unpack('!HHHHHH', data[i: i+12])
-        i += 12
-
-        return DNSHeader(id, "{0:0>16b}".format(flags), questions_count, answers_count, authority_count, additional_count), i
+        return DNSHeader(*_HEADER.unpack_from(data, i)), i + 12
 
     def to_bytes(self) -> bytes:
-        return struct.pack('!HHHHHH', self.id, int(self.flags, base=2), self.qdcount, self.ancount, self.nscount, self.arcount)
+        return _HEADER.pack(self.id, self.flags, self.qdcount, self.ancount, self.nscount, self.arcount)
 
     def rcode(self):
-        return int(self.flags[12:], base=2)
+        return self.flags & 0xF
 
 @dataclasses.dataclass
 class DNSQuestion:
@@ -36,19 +53,20 @@ class DNSQuestion:
     qclass: int
 
     @staticmethod
-    def parse(data, i):
-        qname, i = parse_name(data, i)
-        qtype, qclass = struct.unpack('!HH', data[i:i + 4])
+    def parse(data, i, names=None):
+        qname, i = parse_name(data, i, names)
+        qtype, qclass = _QUESTION_TAIL.unpack_from(data, i)
         i += 4
 
         return DNSQuestion(qname, qtype, qclass), i
 
-    def to_bytes(self) -> bytes:
-        return encode_name(self.qname) + struct.pack('!HH', self.qtype, self.qclass)
+    def to_bytes(self, compression=None, offset=0) -> bytes:
+        return encode_name(self.qname, compression, offset) + _QUESTION_TAIL.pack(self.qtype, self.qclass)
 
 
 @dataclasses.dataclass
 class DNSRecord:
+    __slots__ = ('rname', 'rtype', 'rclass', 'ttl', 'rdlength', 'rdata')
     rname: str
     rtype: int
     rclass: int
@@ -57,25 +75,42 @@ class DNSRecord:
     rdata: bytes
 
     @staticmethod
-    def parse(data, i):
-        rname, i = parse_name(data, i)
-        rtype, rclass, ttl, rdlength = struct.unpack('!HHIH', data[i:i + 10])
+    def parse(data, i, names=None):
+        rname, i = parse_name(data, i, names)
+        rtype, rclass, ttl, rdlength = _RECORD_TAIL.unpack_from(data, i)
         i += 10
+        if i + rdlength > len(data):
+            raise ValueError('RDATA of {} bytes at {} runs past the message'.format(rdlength, i))
+
+        if rtype in COMPRESSED_TYPES:
+            rdata, length = DNSRecord._parse_names(data, i, rtype, rdlength, names)
+            return DNSRecord(rname, rtype, rclass, ttl, length, rdata), i + rdlength
+        return DNSRecord(rname, rtype, rclass, ttl, rdlength, bytes(data[i:i+rdlength])), i + rdlength
 
-        if rtype == NS:
-            name, _ = parse_name(data, i)
-            rdata = name.encode()
-            i += rdlength
-            rdlength = len(encode_name(rdata.decode()))
+    @staticmethod
+    def _parse_names(data, i, rtype, rdlength, names):
+        # RDATA with names that may point into the message, kept uncompressed
+        if rtype in NAME_TYPES:
+            name, _ = parse_name(data, i, names)
+            rdata = name.encode('latin-1')
+            # length of the uncompressed encoding
+            return rdata, len(rdata) + 1 if name != '.' else 1
+        mname, j = parse_name(data, i, names)
+        mailbox, j = parse_name(data, j, names)
+        rdata = encode_name(mname) + encode_name(mailbox) + bytes(data[j:i+rdlength])
+        return rdata, len(rdata)
+
+    def to_bytes(self, compression=None, offset=0) -> bytes:
+        rname = encode_name(self.rname, compression, offset)
+        if self.rtype in NAME_TYPES:
+            rdata = encode_name(self.rdata.decode('latin-1'), compression, offset + len(rname) + 10)
         else:
-            rdata = data[i:i+rdlength]
-            i += rdlength
+            rdata = self.rdata
+        return rname + _RECORD_TAIL.pack(self.rtype, self.rclass, self.ttl, len(rdata)) + rdata
 
-        return DNSRecord(rname, rtype, rclass, ttl, rdlength, rdata), i
-
-    def to_bytes(self) -> bytes:
-        rdata = encode_name(self.rdata.decode()) if self.rtype == NS else self.rdata
-        return encode_name(self.rname) + struct.pack('!HHIH', self.rtype, self.rclass, self.ttl,  self.rdlength) + rdata
+    def soa_minimum(self) -> int:
+        # the last of the SOA's five 32 bit fields, the TTL of negative answers (RFC 2308)
+        return struct.unpack('!I', self.rdata[-4:])[0]
 
     def as_ip(self) -> Optional[str]:
         b = ipaddr.Bytes(self.rdata)
@@ -85,6 +120,21 @@ class DNSRecord:
             return str(ipaddr.IPv4Address(b))
 
 
+class _LazySection:
+    # class attribute of DNSMessage for a record section, only consulted while a parsed message
+    # hasn't decoded its sections yet, the decoded or assigned lists live in the instance
+    def __init__(self, name):
+        self._name = name
+
+    def __get__(self, message, owner=None):
+        if message is None:
+            return self
+        if '_wire' not in message.__dict__:
+            raise AttributeError(self._name)
+        message._parse_sections()
+        return message.__dict__[self._name]
+
+
 @dataclasses.dataclass
 class DNSMessage:
     header: DNSHeader
@@ -93,11 +143,70 @@ class DNSMessage:
     authorities: List[DNSRecord]
     additionals: List[DNSRecord]
 
+    def _parse_sections(self):
+        # DNSRecord.parse inlined: owners that are a single pointer to an already decoded name, the usual
+        # case in responses, are found in `names` and read with the fixed fields in one unpack, and the rest
+        # of an RRset that repeats the owner pointer, type, class, TTL and RDATA length is sliced in one go
+        data, i, names = self.__dict__.pop('_wire')
+        h = self.header
+        unpack_from = _POINTER_RECORD.unpack_from
+        end = len(data)
+        records = []
+        append = records.append
+        remaining = h.ancount + h.nscount + h.arcount
+        while remaining:
+            remaining -= 1
+            start = i
+            rname = None
+            if data[i] >= 0xC0:
+                pointer, rtype, rclass, ttl, rdlength = unpack_from(data, i)
+                rname = names.get(pointer & 0x3FFF)
+            if rname is None:
+                rname, i = parse_name(data, i, names)
+                rtype, rclass, ttl, rdlength = _RECORD_TAIL.unpack_from(data, i)
+                i += 10
+            else:
+                i += 12
+            if i + rdlength > end:
+                raise ValueError('RDATA of {} bytes at {} runs past the message'.format(rdlength, i))
+
+            if rtype in NAME_TYPES:
+                name, _ = parse_name(data, i, names)
+                rdata = name.encode('latin-1')
+                append(DNSRecord(rname, rtype, rclass, ttl, len(rdata) + 1 if name != '.' else 1, rdata))
+                i += rdlength
+            elif rtype == SOA:
+                rdata, length = DNSRecord._parse_names(data, i, rtype, rdlength, names)
+                append(DNSRecord(rname, rtype, rclass, ttl, length, rdata))
+                i += rdlength
+            else:
+                append(DNSRecord(rname, rtype, rclass, ttl, rdlength, data[i:i + rdlength]))
+                i += rdlength
+                if i - start == 12 + rdlength:
+                    head = data[start:start + 12]
+                    step = 12 + rdlength
+                    j = i
+                    while remaining and j + step <= end and data.startswith(head, j):
+                        j += step
+                        remaining -= 1
+                    if j > i:
+                        records += [DNSRecord(rname, rtype, rclass, ttl, rdlength, data[k:k + rdlength])
+                                    for k in range(i + 12, j, step)]
+                        i = j
+
+        # a section assigned before decoding wins
+        answers_end = h.ancount
+        authorities_end = h.ancount + h.nscount
+        self.__dict__.setdefault('answers', records[:answers_end])
+        self.__dict__.setdefault('authorities', records[answers_end:authorities_end])
+        self.__dict__.setdefault('additionals', records[authorities_end:])
+
     @staticmethod
     def from_question(question):
         return DNSMessage(
-            DNSHeader(id=random.randrange(2 ** 16),
-                      flags='0' * 16,
+            # with the source port, the ID is all that tells upstream answers from spoofed ones
+            DNSHeader(id=secrets.randbelow(2 ** 16),
+                      flags=0,
                       qdcount=1,
                       ancount=0,
                       nscount=0,
@@ -111,59 +220,78 @@ class DNSMessage:
 
     @staticmethod
     def parse(data, i=0):
+        # slices of bytes are bytes already, no copy is made if data is bytes
+        data = bytes(data)
+        names = {}
         header, i = DNSHeader.parse(data, i)
         questions = []
         for _ in range(header.qdcount):
-            question, i = DNSQuestion.parse(data, i)
+            question, i = DNSQuestion.parse(data, i, names)
             questions.append(question)
 
-        answers, authorities, additionals = [], [], []
-        for arr, count in [[answers, header.ancount],
-                           [authorities, header.nscount],
-                           [additionals, header.arcount]]:
-            for _ in range(count):
-                resource, i = DNSRecord.parse(data, i)
-                arr.append(resource)
+        # answer, authority and additional records are only decoded when first accessed,
+        # so the returned offset is the end of the question section
+        message = DNSMessage.__new__(DNSMessage)
+        message.header = header
+        message.questions = questions
+        message._wire = (data, i, names)
+        return message, i
+
+    def to_bytes(self, compress=True) -> bytes:
+        compression = {} if compress else None
+        result = bytearray(self.header.to_bytes())
+        for entry in self.questions + self.answers + self.authorities + self.additionals:
+            result += entry.to_bytes(compression, len(result))
+        return bytes(result)
+
+    def _with_header(self, header: DNSHeader):
+        # header-only copy, the question and record lists are shared with the original message
+        result = DNSMessage.__new__(DNSMessage)
+        result.__dict__.update(self.__dict__)
+        result.header = header
+        return result
 
-        return DNSMessage(header, questions, answers, authorities, additionals), i
+    def _with_flags(self, mask, value):
+        h = self.header
+        return self._with_header(DNSHeader(h.id, (h.flags & ~mask) | (value & mask),
+                                           h.qdcount, h.ancount, h.nscount, h.arcount))
 
-    def to_bytes(self) -> bytes:
-        return self.header.to_bytes() + b''.join(map(lambda x: x.to_bytes(), (self.questions + self.answers +
-                                                                              self.authorities + self.additionals)))
-
-    def _with_flag(self, flag_index, flag_value: bool):
-        copy = deepcopy(self)
-        flags = list(copy.header.flags)
-        flags[flag_index] = str(int(flag_value))
-        flags = ''.join(flags)
-        copy.header.flags = flags
-        return copy
+    def with_edns(self, payload_size: int):
+        # OPT pseudo-record: root owner, CLASS carries the UDP payload size, TTL the extended flags
+        additionals = self.additionals + [DNSRecord('.', OPT, payload_size, 0, 0, b'')]
+        result = self._with_header(dataclasses.replace(self.header, arcount=len(additionals)))
+        result.additionals = additionals
+        return result
 
     def as_response(self):
-        return self._with_flag(0, True)
+        return self._with_flags(QR, QR)
 
     def with_AA(self, is_authoritative: bool):
-        return self._with_flag(5, is_authoritative)
+        return self._with_flags(AA, AA if is_authoritative else 0)
 
     def with_TC(self, is_truncated: bool):
-        return self._with_flag(6, is_truncated)
+        return self._with_flags(TC, TC if is_truncated else 0)
 
     def with_RD(self, is_desired: bool):
-        return self._with_flag(7, is_desired)
+        return self._with_flags(RD, RD if is_desired else 0)
 
     def with_RA(self, is_available: bool):
-        return self._with_flag(8, is_available)
+        return self._with_flags(RA, RA if is_available else 0)
 
     def with_rcode(self, rcode: int):
-        bits = "{0:0>4b}".format(rcode)
-
-        result = self
-        for i, v in enumerate(bits):
-            result = result._with_flag(12 + i, v == '1')
-
-        return result
+        return self._with_flags(RCODE, rcode)
 
     def records(self):
         yield from self.answers
         yield from self.authorities
         yield from self.additionals
+
+
+for _section in ('answers', 'authorities', 'additionals'):
+    # set after the dataclass is built, so they aren't taken for field defaults
+    setattr(DNSMessage, _section, _LazySection(_section))
+
+
+def truncate_response(response: bytes, limit=512) -> bytes:
+    message = DNSMessage.parse(response)[0]
+    return message.with_TC(is_truncated=True).to_bytes()[:limit]
@@ -0,0 +1,186 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds in seconds, from a cache hit to a slow upstream
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+           0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# engine stats keyed by nameserver address, left out of /metrics
+PER_SERVER_STATS = {'upstream_servers'}
+
+
+class _Shard:
+    # written by one thread only, so updates need no lock
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [count per bucket..., +Inf count, sum]
+
+
+class Metrics:
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def _shard(self) -> _Shard:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def inc(self, name, value=1, **labels):
+        counters = self._shard().counters
+        key = (name, tuple(labels.items()))
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        histograms = self._shard().histograms
+        key = (name, tuple(labels.items()))
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(BUCKETS) + 2)
+        histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+    def timer(self, name, **labels):
+        return _Timer(self, name, labels)
+
+    def snapshot(self) -> dict:
+        # nested dicts of numbers, so snapshots of several workers can simply be summed
+        counters = {}
+        histograms = {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for (name, labels), value in list(shard.counters.items()):
+                series = counters.setdefault(name, {})
+                key = _format_labels(labels)
+                series[key] = series.get(key, 0) + value
+            for (name, labels), histogram in list(shard.histograms.items()):
+                series = histograms.setdefault(name, {})
+                total = series.setdefault(_format_labels(labels), {
+                    'buckets': {str(bound): 0 for bound in BUCKETS + ('+Inf',)}, 'sum': 0.0, 'count': 0,
+                })
+                for bound, count in zip(BUCKETS + ('+Inf',), histogram):
+                    total['buckets'][str(bound)] += count
+                total['sum'] += histogram[-1]
+                total['count'] += sum(histogram[:-1])
+        return {'counters': counters, 'histograms': histograms}
+
+
+class _Timer:
+    __slots__ = ('_metrics', '_name', '_labels', '_started')
+
+    def __init__(self, metrics, name, labels):
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._metrics.observe(self._name, time.perf_counter() - self._started, **self._labels)
+
+
+def _format_labels(labels) -> str:
+    return ','.join('{}="{}"'.format(k, v) for k, v in labels)
+
+
+def _with_labels(name, labels, extra=''):
+    labels = ','.join(label for label in (labels, extra) if label)
+    return '{}{{{}}}'.format(name, labels) if labels else name
+
+
+def _gauges(prefix, stats, labels=''):
+    # flattens engine stats, keys that can't be part of a metric name (e.g. server IPs) become labels
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            if key.isidentifier():
+                yield from _gauges('{}_{}'.format(prefix, key), value, labels)
+            else:
+                yield from _gauges(prefix, value, ','.join(l for l in (labels, 'key="{}"'.format(key)) if l))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield _with_labels('{}_{}'.format(prefix, key), labels), value
+
+
+def to_prometheus(stats: dict) -> str:
+    # stats is {'metrics': Metrics.snapshot(), 'engine': ResolutionEngine.stats()}
+    lines = []
+    snapshot = stats.get('metrics', {})
+    for name, series in sorted(snapshot.get('counters', {}).items()):
+        lines.append('# TYPE dns_{} counter'.format(name))
+        for labels, value in sorted(series.items()):
+            lines.append('{} {}'.format(_with_labels('dns_' + name, labels), value))
+    for name, series in sorted(snapshot.get('histograms', {}).items()):
+        lines.append('# TYPE dns_{} histogram'.format(name))
+        for labels, histogram in sorted(series.items()):
+            cumulative = 0
+            for bound, count in histogram['buckets'].items():
+                cumulative += count
+                lines.append('{} {}'.format(
+                    _with_labels('dns_{}_bucket'.format(name), labels, 'le="{}"'.format(bound)), cumulative))
+            lines.append('{} {}'.format(_with_labels('dns_{}_sum'.format(name), labels), histogram['sum']))
+            lines.append('{} {}'.format(_with_labels('dns_{}_count'.format(name), labels), histogram['count']))
+    engine = {key: value for key, value in stats.get('engine', {}).items() if key not in PER_SERVER_STATS}
+    for series, value in _gauges('dns_engine', engine):
+        lines.append('{} {}'.format(series, value))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    # /metrics in the Prometheus text format, /stats as JSON
+    def __init__(self, host, port, get_stats):
+        self._host = host
+        self._port = port
+        self._get_stats = get_stats
+        self._server = None
+
+    def start(self):
+        get_stats = self._get_stats
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                try:
+                    if self.path == '/metrics':
+                        body, content_type = to_prometheus(get_stats()).encode(), 'text/plain; version=0.0.4'
+                    elif self.path == '/stats':
+                        body, content_type = json.dumps(get_stats()).encode(), 'application/json'
+                    else:
+                        self.send_error(404)
+                        return
+                except Exception as e:
+                    logging.warning("Error with metrics export: `{}`, will continue w/o it".format(e))
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug('[MetricsServer] ' + format % args)
+
+        self._server = ThreadingHTTPServer((self._host, self._port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        logging.info('[{}] serving metrics on http://{}:{}/metrics'.format(self.__class__.__name__,
+                                                                           self._host, self._port))
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+metrics = Metrics()
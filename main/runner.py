@@ -5,8 +5,15 @@ from pathlib import Path
 from os.path import *
 import site
 import time
+import signal
+import asyncio
 from main.listeners import *
 from main.resolver import Resolver
+from main.servers import serve
+from main.engine import ResolutionEngine
+from main.storage import CacheStorage
+from main.workers import WorkerPool
+from main.metrics import MetricsServer, metrics
 import pykka
 
 
@@ -38,26 +45,170 @@ def parse_args(argv):
     p.add_argument('-c', '--config', required=False, is_config_file=True, help='Config file path')
     p.add_argument('--logging_level', required=True, help='Logging level')
     p.add_argument('--protocol', required=True, choices=['tcp', 'udp', 'both'], help='')
+    p.add_argument('--engine', required=False, default='pykka', choices=['pykka', 'asyncio'],
+                   help='Serve clients with pykka listener actors or with asyncio servers')
     p.add_argument('--host', required=True, help='')
     p.add_argument('--port', required=True, type=int, help='')
     p.add_argument('--root_servers', required=True, action='append', help='')
     p.add_argument('--cache_location', required=True, type=expanduser)
+    p.add_argument('--memory_cache_size', required=False, type=int, default=10000,
+                   help='Max number of (name, type) entries kept in the in-memory answer cache')
+    p.add_argument('--cache_sweep_interval', required=False, type=float, default=60,
+                   help='Seconds between background purges of expired cache entries')
+    p.add_argument('--cache_journal_mode', required=False, default='WAL',
+                   choices=['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'],
+                   help='SQLite journal mode of the cache file')
+    p.add_argument('--cache_synchronous', required=False, default='NORMAL',
+                   choices=['OFF', 'NORMAL', 'FULL', 'EXTRA'],
+                   help='SQLite synchronous level of the cache file, trades durability for throughput')
+    p.add_argument('--cache_write_batch_size', required=False, type=int, default=256,
+                   help='Number of queued records that triggers a cache write')
+    p.add_argument('--cache_write_flush_interval', required=False, type=float, default=1.0,
+                   help='Max seconds a queued record waits before being written to the cache')
+    p.add_argument('--query_timeout', required=False, type=float, default=10.0,
+                   help='Deadline in seconds for resolving a single client query')
+    p.add_argument('--stagger_delay', required=False, type=float, default=0.3,
+                   help='Seconds to wait for a nameserver before also asking the next one')
+    p.add_argument('--edns_buffer_size', required=False, type=int, default=1232,
+                   help='EDNS0 UDP payload size advertised upstream, 0 disables EDNS0')
+    p.add_argument('--upstream_tcp_idle_timeout', required=False, type=float, default=10.0,
+                   help='Seconds an idle pooled TCP connection to a nameserver is kept open')
+    p.add_argument('--upstream_tcp_max_lifetime', required=False, type=float, default=120.0,
+                   help='Max seconds a pooled TCP connection to a nameserver is reused')
+    p.add_argument('--shared_cache_location', required=False, type=expanduser, default=None,
+                   help='Memory-mapped file shared by local resolver processes as a record cache, off if unset')
+    p.add_argument('--shared_cache_slots', required=False, type=int, default=65536,
+                   help='Number of fixed-size slots in the shared cache file')
+    p.add_argument('--shared_cache_slot_size', required=False, type=int, default=512,
+                   help='Bytes per slot of the shared cache file, larger RRsets are not shared')
+    p.add_argument('--prefetch_min_hits', required=False, type=int, default=5,
+                   help='Answers hit more than this many times are refreshed before they expire')
+    p.add_argument('--prefetch_window', required=False, type=float, default=0.1,
+                   help='Fraction of the TTL left when popular answers get refreshed, 0 turns prefetch off')
+    p.add_argument('--prefetch_interval', required=False, type=float, default=1.0,
+                   help='Seconds between scans for answers to prefetch')
+    p.add_argument('--serve_stale_window', required=False, type=int, default=0,
+                   help='Seconds expired records are kept to answer with when upstream fails (RFC 8767), 0 is off')
+    p.add_argument('--stale_answer_deadline', required=False, type=float, default=1.8,
+                   help='Seconds a client waits for upstream before stale records are answered')
+    p.add_argument('--stale_answer_ttl', required=False, type=int, default=30,
+                   help='TTL of stale records in answers')
+    p.add_argument('--negative_cache_size', required=False, type=int, default=10000,
+                   help='Max number of NXDOMAIN and NODATA answers kept in memory')
+    p.add_argument('--negative_cache_max_ttl', required=False, type=int, default=10800,
+                   help='Upper bound in seconds for caching NXDOMAIN and NODATA answers')
+    p.add_argument('--upstream_min_timeout', required=False, type=float, default=0.2,
+                   help='Lower bound in seconds of the per-server timeout derived from its measured RTT')
+    p.add_argument('--upstream_max_timeout', required=False, type=float, default=5.0,
+                   help='Upper bound in seconds of the per-server timeout, also used for unmeasured servers')
+    p.add_argument('--upstream_port', required=False, type=int, default=53,
+                   help='Port nameservers are queried on, only useful for testing against local servers')
+    p.add_argument('--warm_start_size', required=False, type=int, default=10000,
+                   help='Max number of unexpired answers loaded from the cache file at startup, 0 turns warm start off')
+    p.add_argument('--hot_set_location', required=False, type=expanduser, default=None,
+                   help='File the most recently answered names are saved to and preloaded from at startup, off if unset')
+    p.add_argument('--hot_set_size', required=False, type=int, default=1000,
+                   help='Max number of names kept in the hot set file')
+    p.add_argument('--hot_set_interval', required=False, type=float, default=300,
+                   help='Seconds between hot set snapshots')
+    p.add_argument('--preload_names', required=False, type=expanduser, default=None,
+                   help='File of `name [type]` lines resolved at startup')
+    p.add_argument('--preload_concurrency', required=False, type=int, default=20,
+                   help='Max number of names resolved at once while preloading')
+    p.add_argument('--tcp_idle_timeout', required=False, type=float, default=10.0,
+                   help='Seconds a client TCP connection without pending queries is kept open')
+    p.add_argument('--tcp_max_connections', required=False, type=int, default=256,
+                   help='Max number of client TCP connections served at once, more are closed right away')
+    p.add_argument('--tcp_max_pipelined', required=False, type=int, default=32,
+                   help='Max number of queries of one TCP connection being resolved at once')
+    p.add_argument('--udp_batch_size', required=False, type=int, default=64,
+                   help='Max number of datagrams the pykka UDP listener reads and hands to the resolver at once')
+    p.add_argument('--udp_rcvbuf', required=False, type=int, default=0,
+                   help='Receive buffer size in bytes of the UDP socket, 0 keeps the system default')
+    p.add_argument('--udp_max_pending', required=False, type=int, default=10000,
+                   help='Max number of UDP queries being resolved at once, further cache misses are dropped')
+    p.add_argument('--workers', required=False, type=int, default=1,
+                   help='Number of worker processes sharing the port through SO_REUSEPORT')
+    p.add_argument('--worker_stats_interval', required=False, type=float, default=10.0,
+                   help='Seconds between stats reports of the workers to the parent process')
+    p.add_argument('--wire_cache_size', required=False, type=int, default=10000,
+                   help='Max number of encoded answers kept for the cache hit fast path')
+    p.add_argument('--metrics_host', required=False, default='127.0.0.1',
+                   help='Address of the HTTP endpoint serving /metrics and /stats')
+    p.add_argument('--metrics_port', required=False, type=int, default=9153,
+                   help='Port of the HTTP endpoint serving /metrics and /stats, 0 disables it')
     args = p.parse_args(argv)
 
     return args
 
-def main():
-    args = parse_args(sys.argv[1:])
-    set_logging_level(args.logging_level)
+def engine_options(args):
+    return dict(root_servers=args.root_servers,
+                cache_location=args.cache_location,
+                memory_cache_size=args.memory_cache_size,
+                cache_sweep_interval=args.cache_sweep_interval,
+                cache_journal_mode=args.cache_journal_mode,
+                cache_synchronous=args.cache_synchronous,
+                cache_write_batch_size=args.cache_write_batch_size,
+                cache_write_flush_interval=args.cache_write_flush_interval,
+                query_timeout=args.query_timeout,
+                stagger_delay=args.stagger_delay,
+                edns_buffer_size=args.edns_buffer_size,
+                upstream_tcp_idle_timeout=args.upstream_tcp_idle_timeout,
+                upstream_tcp_max_lifetime=args.upstream_tcp_max_lifetime,
+                wire_cache_size=args.wire_cache_size,
+                shared_cache_location=args.shared_cache_location,
+                shared_cache_slots=args.shared_cache_slots,
+                shared_cache_slot_size=args.shared_cache_slot_size,
+                prefetch_min_hits=args.prefetch_min_hits,
+                prefetch_window=args.prefetch_window,
+                prefetch_interval=args.prefetch_interval,
+                serve_stale_window=args.serve_stale_window,
+                stale_answer_deadline=args.stale_answer_deadline,
+                stale_answer_ttl=args.stale_answer_ttl,
+                negative_cache_size=args.negative_cache_size,
+                negative_cache_max_ttl=args.negative_cache_max_ttl,
+                upstream_min_timeout=args.upstream_min_timeout,
+                upstream_max_timeout=args.upstream_max_timeout,
+                upstream_port=args.upstream_port,
+                warm_start_size=args.warm_start_size,
+                hot_set_location=args.hot_set_location,
+                hot_set_size=args.hot_set_size,
+                hot_set_interval=args.hot_set_interval,
+                preload_names=args.preload_names,
+                preload_concurrency=args.preload_concurrency)
+
+
+def run_asyncio(args, reuse_port=False, report_stats=None):
+    engine = ResolutionEngine(**engine_options(args))
+    if report_stats is not None:
+        report_stats(engine.stats_threadsafe)
+
+    try:
+        asyncio.run(serve(engine, args.host, args.port, args.protocol, reuse_port, args.tcp_idle_timeout,
+                          args.tcp_max_connections, args.tcp_max_pipelined, args.udp_rcvbuf,
+                          args.udp_max_pending))
+    except KeyboardInterrupt:
+        logging.info('Interrupted, exiting gracefully')
+    except Exception as e:
+        logging.error('Unhandled exception generated: {}, exiting non-gracefully'.format(e))
+        sys.exit(1)
 
-    resolver_ref = Resolver.start(args.root_servers, args.cache_location)
+
+def run_pykka(args, reuse_port=False, report_stats=None):
+    resolver_ref = Resolver.start(**engine_options(args))
+    # answered once on_start has run, so the cache is warm before the listeners bind
+    resolver_ref.ask({'command': 'stats'})
+    if report_stats is not None:
+        report_stats(lambda: resolver_ref.ask({'command': 'stats'}))
 
     if args.protocol in {'tcp', 'both'}:
-        ref = TCPListener.start(args.host, args.port, resolver_ref)
+        ref = TCPListener.start(args.host, args.port, resolver_ref, reuse_port, args.tcp_idle_timeout,
+                                args.tcp_max_connections, args.tcp_max_pipelined)
         ref.tell({'command': 'start'})
 
     if args.protocol in {'udp', 'both'}:
-        ref = UDPListener.start(args.host, args.port, resolver_ref)
+        ref = UDPListener.start(args.host, args.port, resolver_ref, reuse_port, args.udp_batch_size,
+                                args.udp_rcvbuf, args.udp_max_pending)
         ref.tell({'command': 'start'})
 
     try:
@@ -71,5 +222,53 @@ def main():
         sys.exit(1)
 
 
+def with_metrics(get_engine_stats):
+    return lambda: {'engine': get_engine_stats(), 'metrics': metrics.snapshot()}
+
+
+def start_metrics_server(args, get_stats):
+    if not args.metrics_port:
+        return
+    try:
+        MetricsServer(args.metrics_host, args.metrics_port, get_stats).start()
+    except Exception as e:
+        logging.warning("Error with metrics server: `{}`, will continue w/o it".format(e))
+
+
+def run_workers(args, run):
+    # migrate the shared cache file once, before the workers open it concurrently
+    storage = CacheStorage(args.cache_location, args.cache_journal_mode, args.cache_synchronous)
+    try:
+        storage.open()
+    except Exception as e:
+        logging.warning("Error with cache init: `{}`, will continue w/o it".format(e))
+    finally:
+        storage.close()
+
+    # SIGTERM (kill, systemd, docker) stops the workers like Ctrl-C, instead of leaving them bound to the port
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    pool = WorkerPool(lambda report_stats: run(args, True, lambda get_stats: report_stats(with_metrics(get_stats))),
+                      args.workers, args.worker_stats_interval)
+    try:
+        pool.start()
+        start_metrics_server(args, pool.aggregated_stats)
+        pool.supervise()
+    except KeyboardInterrupt:
+        logging.info('Interrupted, stopping workers')
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        pool.stop()
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    set_logging_level(args.logging_level)
+
+    run = run_asyncio if args.engine == 'asyncio' else run_pykka
+    if args.workers > 1:
+        run_workers(args, run)
+    else:
+        run(args, report_stats=lambda get_stats: start_metrics_server(args, with_metrics(get_stats)))
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,125 @@
+import random
+import time
+from typing import List, Tuple
+
+
+class ServerStats:
+    __slots__ = ('srtt', 'rttvar', 'queries', 'failures', 'timeouts', 'held_until', 'last_used')
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.queries = 0
+        self.failures = 0  # consecutive
+        self.timeouts = 0
+        self.held_until = 0.0
+        self.last_used = 0.0
+
+
+class ServerSelector:
+    # Smoothed RTT per nameserver IP as in RFC 6298 (alpha 1/8, beta 1/4). Servers are tried fastest first,
+    # unknown ones before known ones so they get measured, and now and then a random one goes first so a
+    # server that got faster is noticed. Failures back off exponentially up to a holddown, held servers
+    # are only tried after all the others. A query given up on before the answer came, e.g. because
+    # another server won, tells the RTT is at least that long, so a slow server doesn't stay unknown.
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    EXPLORE = 0.05
+    HOLDDOWN_BASE = 1.0
+    HOLDDOWN_MAX = 60.0
+    IDLE_EXPIRY = 600.0  # seconds without queries before a server's measurements are dropped
+
+    def __init__(self, min_timeout=0.2, max_timeout=5.0):
+        self._min_timeout = min_timeout
+        self._max_timeout = max_timeout
+        self._servers = {}  # ip -> ServerStats
+
+    def _stats(self, ip) -> ServerStats:
+        stats = self._servers.get(ip)
+        if stats is None:
+            stats = self._servers[ip] = ServerStats()
+        stats.last_used = time.monotonic()
+        return stats
+
+    def record_rtt(self, ip, rtt):
+        stats = self._stats(ip)
+        stats.queries += 1
+        stats.failures = 0
+        stats.held_until = 0.0
+        if stats.srtt is None:
+            stats.srtt = rtt
+            stats.rttvar = rtt / 2
+        else:
+            stats.rttvar = (1 - self.BETA) * stats.rttvar + self.BETA * abs(stats.srtt - rtt)
+            stats.srtt = (1 - self.ALPHA) * stats.srtt + self.ALPHA * rtt
+
+    def record_lower_bound(self, ip, elapsed):
+        stats = self._stats(ip)
+        stats.queries += 1
+        if stats.srtt is None:
+            stats.srtt = elapsed
+            stats.rttvar = elapsed / 2
+        else:
+            stats.srtt = max(stats.srtt, elapsed)
+
+    def record_failure(self, ip, timed_out=True):
+        stats = self._stats(ip)
+        stats.queries += 1
+        stats.failures += 1
+        stats.timeouts += timed_out
+        stats.held_until = time.monotonic() + min(self.HOLDDOWN_BASE * 2 ** (stats.failures - 1), self.HOLDDOWN_MAX)
+        if stats.srtt is not None:
+            # a silent server must look slow until it answers again
+            stats.srtt = min(stats.srtt * 2, self._max_timeout)
+
+    def timeout(self, ip) -> float:
+        stats = self._servers.get(ip)
+        if stats is None or stats.srtt is None:
+            return self._max_timeout
+        return max(self._min_timeout, min(stats.srtt + 4 * stats.rttvar, self._max_timeout))
+
+    def order(self, servers: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        # servers are (name, ip)
+        now = time.monotonic()
+        available = []
+        held = []
+        for server in servers:
+            stats = self._servers.get(server[-1])
+            if stats is not None and stats.held_until > now:
+                held.append((stats.held_until, server))
+            else:
+                # unknown servers first, then by srtt, ties broken at random
+                if stats is None:
+                    srtt = -1
+                else:
+                    srtt = stats.srtt if stats.srtt is not None else self._max_timeout
+                available.append((srtt, random.random(), server))
+
+        ordered = [server for _, _, server in sorted(available)]
+        if len(ordered) > 1 and random.random() < self.EXPLORE:
+            i = random.randrange(1, len(ordered))
+            ordered[0], ordered[i] = ordered[i], ordered[0]
+        return ordered + [server for _, server in sorted(held)]
+
+    def prune(self) -> int:
+        # servers that weren't asked for a while start over as unknown, held ones are kept until released
+        now = time.monotonic()
+        idle = [ip for ip, s in self._servers.items() if s.last_used + self.IDLE_EXPIRY < now and s.held_until <= now]
+        for ip in idle:
+            del self._servers[ip]
+        return len(idle)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            ip: {
+                'srtt_ms': round(s.srtt * 1000, 1) if s.srtt is not None else None,
+                'rttvar_ms': round(s.rttvar * 1000, 1) if s.rttvar is not None else None,
+                'timeout_ms': round(self.timeout(ip) * 1000, 1),
+                'queries': s.queries,
+                'failures': s.failures,
+                'timeouts': s.timeouts,
+                'held_for': round(max(0.0, s.held_until - now), 1),
+            }
+            for ip, s in self._servers.items()
+        }
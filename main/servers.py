@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import socket
+import struct
+from main.engine import ResolutionEngine
+from main.messages import truncate_response
+from main.metrics import metrics
+from main.utils import write_tcp_message
+
+
+class UDPServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, engine: ResolutionEngine, max_pending=10000):
+        self._engine = engine
+        self._transport = None
+        self._in_flight = set()
+        self._max_pending = max_pending
+
+    def connection_made(self, transport):
+        logging.info('[{}] opening socket'.format(self.__class__.__name__))
+        self._transport = transport
+
+    def datagram_received(self, data, addr):
+        logging.debug('[%s] received data from `%s`: %s', self.__class__.__name__, addr, data)
+        response = self._engine.cached_response(data)
+        if response is not None:
+            if len(response) > 512:
+                response = truncate_response(response)
+            self._transport.sendto(response, addr)
+            return
+
+        if len(self._in_flight) >= self._max_pending:
+            metrics.inc('udp_dropped', reason='overload')
+            return
+
+        task = asyncio.ensure_future(self._respond(data, addr))
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+    async def _respond(self, data, addr):
+        try:
+            response = await self._engine.resolve_uncached(data)
+            logging.debug('[%s] response is: %s', self.__class__.__name__, response)
+
+            if len(response) > 512:
+                logging.debug('UDP response is `%s` bytes length, truncating', len(response))
+                response = truncate_response(response)
+
+            with metrics.timer('stage_seconds', stage='send'):
+                self._transport.sendto(response, addr)
+        except Exception as e:
+            logging.error('[{}] unhandled exception: {}'.format(self.__class__.__name__, e))
+
+
+class TCPServer:
+    # queries of a connection are resolved concurrently and answered as they complete (RFC 7766),
+    # connections without pending queries are closed after idle_timeout
+    MESSAGE_TIMEOUT = 10.0  # seconds a client gets to finish a message once its length arrived
+
+    def __init__(self, engine: ResolutionEngine, idle_timeout=10.0, max_connections=256, max_pipelined=32):
+        self._engine = engine
+        self._idle_timeout = idle_timeout
+        self._max_connections = max_connections
+        self._max_pipelined = max_pipelined
+        self._connections = 0
+
+    async def handle(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        if self._connections >= self._max_connections:
+            logging.debug('[%s] %s connections open, refusing %s', self.__class__.__name__, self._connections, addr)
+            metrics.inc('tcp_connections_closed', reason='limit')
+            writer.close()
+            return
+
+        logging.debug('[{}] connected by {}'.format(self.__class__.__name__, addr))
+        self._connections += 1
+        slots = asyncio.Semaphore(self._max_pipelined)
+        lock = asyncio.Lock()
+        pending = set()
+        try:
+            while True:
+                try:
+                    # only the wait for the next length is cancelled, readexactly consumes nothing until
+                    # all its bytes are there
+                    length = await asyncio.wait_for(reader.readexactly(2), self._idle_timeout)
+                except asyncio.TimeoutError:
+                    if pending:
+                        continue
+                    logging.debug('[%s] %s idle, closing', self.__class__.__name__, addr)
+                    metrics.inc('tcp_connections_closed', reason='idle')
+                    break
+                try:
+                    data = await asyncio.wait_for(reader.readexactly(struct.unpack('!H', length)[0]),
+                                                  self.MESSAGE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    # the length is consumed already, the stream can't be resumed
+                    logging.debug('[%s] %s stalled mid-message, closing', self.__class__.__name__, addr)
+                    metrics.inc('tcp_connections_closed', reason='stalled')
+                    break
+                logging.debug('[%s] received data: %s', self.__class__.__name__, data)
+
+                await slots.acquire()
+                task = asyncio.ensure_future(self._respond(data, writer, lock))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                task.add_done_callback(lambda _: slots.release())
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logging.error('[{}] unhandled exception: {}'.format(self.__class__.__name__, e))
+        finally:
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            writer.close()
+            self._connections -= 1
+        logging.debug('[{}] {} disconnected'.format(self.__class__.__name__, addr))
+
+    async def _respond(self, data, writer, lock):
+        try:
+            response = await self._engine.resolve(data)
+            logging.debug('[%s] response is: %s', self.__class__.__name__, response)
+            async with lock:
+                with metrics.timer('stage_seconds', stage='send'):
+                    await write_tcp_message(writer, response)
+        except ConnectionError:
+            pass
+        except Exception as e:
+            logging.error('[{}] unhandled exception: {}'.format(self.__class__.__name__, e))
+
+
+async def serve(engine: ResolutionEngine, host, port, protocol, reuse_port=False, tcp_idle_timeout=10.0,
+                tcp_max_connections=256, tcp_max_pipelined=32, udp_rcvbuf=0, udp_max_pending=10000):
+    loop = asyncio.get_running_loop()
+    await engine.start()
+
+    closables = []
+    try:
+        if protocol in {'tcp', 'both'}:
+            logging.info('[{}] opening socket'.format(TCPServer.__name__))
+            tcp_server = TCPServer(engine, tcp_idle_timeout, tcp_max_connections, tcp_max_pipelined)
+            server = await asyncio.start_server(tcp_server.handle, host, port, reuse_port=reuse_port)
+            closables.append(server)
+
+        if protocol in {'udp', 'both'}:
+            transport, _ = await loop.create_datagram_endpoint(lambda: UDPServerProtocol(engine, udp_max_pending),
+                                                               local_addr=(host, port), reuse_port=reuse_port)
+            if udp_rcvbuf:
+                sock = transport.get_extra_info('socket')
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, udp_rcvbuf)
+                logging.info('[{}] receive buffer is {} bytes'.format(
+                    UDPServerProtocol.__name__, sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)))
+            closables.append(transport)
+
+        await asyncio.Event().wait()
+    finally:
+        for closable in closables:
+            closable.close()
+        await engine.stop()
@@ -0,0 +1,166 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import time
+from typing import List, Optional
+from main.messages import DNSRecord
+
+MAGIC = b'DNSSHM01'
+_FILE_HEADER = struct.Struct('!8sII')  # magic, slots, slot size
+_SLOT_HEADER = struct.Struct('!I4xdHH')  # sequence, expires_at, key length, data length
+_SEQUENCE = struct.Struct('!I')
+
+
+class SharedAnswerCache:
+    # A fixed-slot hash table in a memory-mapped file, shared by every process that maps the same file
+    # and kept across restarts. Each slot holds a (name, type) key, the uncompressed wire format of its
+    # records and their absolute expiry. Writers take an flock and bump the slot's sequence to odd while
+    # they write and back to even afterwards, readers don't lock and retry when the sequence moved.
+    PROBES = 4
+    READ_RETRIES = 8
+
+    def __init__(self, location, slots=65536, slot_size=512):
+        self._location = location
+        self._slots = slots
+        self._slot_size = slot_size
+        self._fd = None
+        self._map = None
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.overwrites = 0
+        self.oversize = 0
+        self.retries = 0
+
+    def open(self):
+        if self._map is not None:
+            return
+
+        size = _FILE_HEADER.size + self._slots * self._slot_size
+        self._fd = os.open(self._location, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(self._fd, _FILE_HEADER.size, 0)
+            if len(header) < _FILE_HEADER.size or _FILE_HEADER.unpack(header) != (MAGIC, self._slots, self._slot_size):
+                # new file or another layout, start over with empty slots
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, _FILE_HEADER.pack(MAGIC, self._slots, self._slot_size), 0)
+            self._map = mmap.mmap(self._fd, size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    @staticmethod
+    def _key(name: str, rtype: int) -> bytes:
+        return name.lower().encode() + struct.pack('!H', rtype)
+
+    def _offsets(self, key: bytes):
+        # the hash has to be the same in every process, unlike hash()
+        index = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big') % self._slots
+        for probe in range(self.PROBES):
+            yield _FILE_HEADER.size + (index + probe) % self._slots * self._slot_size
+
+    def _read_slot(self, offset):
+        for _ in range(self.READ_RETRIES):
+            sequence = _SEQUENCE.unpack_from(self._map, offset)[0]
+            if sequence & 1:
+                self.retries += 1
+                continue
+            slot = self._map[offset:offset + self._slot_size]
+            if _SEQUENCE.unpack_from(self._map, offset)[0] != sequence:
+                self.retries += 1
+                continue
+            return slot
+
+    def get(self, name: str, rtype: int) -> Optional[List[DNSRecord]]:
+        if self._map is None:
+            return None
+
+        key = self._key(name, rtype)
+        now = time.time()
+        for offset in self._offsets(key):
+            slot = self._read_slot(offset)
+            if slot is None:
+                # busy or torn, the key may still be in one of the next slots
+                continue
+            _, expires_at, key_length, data_length = _SLOT_HEADER.unpack_from(slot)
+            if key_length == 0:
+                break
+            data_start = _SLOT_HEADER.size + key_length
+            if slot[_SLOT_HEADER.size:data_start] != key:
+                continue
+            if expires_at <= now:
+                break
+
+            remaining = int(expires_at - now)
+            records = []
+            i = data_start
+            while i < data_start + data_length:
+                record, i = DNSRecord.parse(slot, i)
+                record.ttl = remaining
+                records.append(record)
+            self.hits += 1
+            return records
+
+        self.misses += 1
+        return None
+
+    def put(self, name: str, rtype: int, records: List[DNSRecord], expires_at: Optional[float] = None):
+        if not records or self._map is None:
+            return
+
+        now = time.time()
+        if expires_at is None:
+            expires_at = now + min(r.ttl for r in records)
+
+        key = self._key(name, rtype)
+        data = b''.join(r.to_bytes() for r in records)
+        if _SLOT_HEADER.size + len(key) + len(data) > self._slot_size:
+            self.oversize += 1
+            return
+
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            # take the slot of the same key, else a free or expired one, else the one expiring first
+            candidates = []
+            for offset in self._offsets(key):
+                _, slot_expires_at, key_length, _ = _SLOT_HEADER.unpack_from(self._map, offset)
+                slot_key = self._map[offset + _SLOT_HEADER.size:offset + _SLOT_HEADER.size + key_length]
+                if slot_key == key or key_length == 0 or slot_expires_at <= now:
+                    target = offset
+                    break
+                candidates.append((slot_expires_at, offset))
+            else:
+                target = min(candidates)[1]
+                self.overwrites += 1
+
+            # odd if a writer died halfway, its slot would stay unreadable unless we start over from even
+            sequence = _SEQUENCE.unpack_from(self._map, target)[0] & ~1
+            _SEQUENCE.pack_into(self._map, target, sequence + 1)
+            body = _SLOT_HEADER.pack(sequence + 1, expires_at, len(key), len(data)) + key + data
+            self._map[target:target + len(body)] = body
+            _SEQUENCE.pack_into(self._map, target, (sequence + 2) & 0xFFFFFFFF)
+            self.writes += 1
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def stats(self) -> dict:
+        return {
+            'slots': self._slots,
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'overwrites': self.overwrites,
+            'oversize': self.oversize,
+            'retries': self.retries,
+        }
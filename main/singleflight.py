@@ -0,0 +1,28 @@
+import asyncio
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}  # key -> task shared by every caller of that key
+        self.started = 0
+        self.joined = 0
+
+    async def do(self, key, coroutine_factory):
+        task = self._calls.get(key)
+        if task is not None:
+            self.joined += 1
+        else:
+            task = asyncio.ensure_future(coroutine_factory())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+            self.started += 1
+
+        # a caller giving up (e.g. hitting its deadline) must not cancel the lookup for the others
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': len(self._calls),
+            'started': self.started,
+            'joined': self.joined,
+        }
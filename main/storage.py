@@ -0,0 +1,209 @@
+import sqlite3
+import logging
+import time
+from typing import Iterable, List, Optional, Tuple
+from main.messages import DNSRecord
+from main.constants import *
+
+SCHEMA_VERSION = 1
+
+
+class CacheStorage:
+    def __init__(self, location, journal_mode='WAL', synchronous='NORMAL'):
+        self._location = location
+        self._journal_mode = journal_mode
+        self._synchronous = synchronous
+        self._conn = None
+
+    def open(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self._location)
+            self._conn.execute('PRAGMA journal_mode = {};'.format(self._journal_mode))
+            self._conn.execute('PRAGMA synchronous = {};'.format(self._synchronous))
+            self._migrate()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _migrate(self):
+        version = self._conn.execute('PRAGMA user_version;').fetchone()[0]
+        if version == SCHEMA_VERSION:
+            return
+        if version > SCHEMA_VERSION:
+            raise Exception('Cache schema version `{}` is newer than supported `{}`'.format(version, SCHEMA_VERSION))
+
+        with self._conn:
+            legacy_rows = []
+            tables = {row[0] for row in self._conn.execute("SELECT name FROM sqlite_master WHERE type = 'table';")}
+            if 'cache' in tables:
+                # version 0: (name, type, ttl, insertion_time, data, ns) without indexes
+                legacy_rows = list(self._conn.execute("""
+                SELECT data, insertion_time
+                FROM cache
+                WHERE strftime('%s', 'now') - insertion_time <= ttl;
+                """))
+                self._conn.execute('DROP TABLE cache;')
+
+            # name and ns are stored lowercased, so lookups and the NS -> A join hit the primary key
+            self._conn.execute("""
+            CREATE TABLE cache (
+                name TEXT NOT NULL,
+                type INT NOT NULL,
+                rdata BLOB NOT NULL,
+                ttl INT NOT NULL,
+                insertion_time INT NOT NULL,
+                expires_at INT NOT NULL,
+                data BLOB NOT NULL,
+                ns TEXT,
+                PRIMARY KEY (name, type, rdata)
+            );
+            """)
+            self._conn.execute('CREATE INDEX cache_expires_at ON cache (expires_at);')
+
+            self._conn.executemany(self._INSERT, [
+                self._row(DNSRecord.parse(data, 0)[0], insertion_time)
+                for data, insertion_time in legacy_rows
+            ])
+
+            self._conn.execute('PRAGMA user_version = {};'.format(SCHEMA_VERSION))
+        logging.info('Migrated cache schema from version `{}` to `{}`, kept `{}` entries'.format(
+            version, SCHEMA_VERSION, len(legacy_rows)))
+
+    _INSERT = """
+    INSERT OR REPLACE INTO cache(name, type, rdata, ttl, insertion_time, expires_at, data, ns)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+    """
+
+    @staticmethod
+    def _row(record: DNSRecord, now: int):
+        ns = record.rdata.decode('latin-1').lower() if record.rtype == NS else None
+        return (record.rname.lower(), record.rtype, record.rdata, record.ttl, now, now + record.ttl,
+                record.to_bytes(), ns)
+
+    def insert_many(self, records: Iterable[Tuple[DNSRecord, int]]):
+        with self._conn:
+            self._conn.executemany(self._INSERT, [
+                self._row(record, now)
+                for record, now in records
+            ])
+
+    def lookup_answer(self, name: str, rtype: int, now: int) -> List[Tuple[bytes, int]]:
+        return list(self._conn.execute("""
+        SELECT data, expires_at
+        FROM cache
+        WHERE name = ? and type = ? and expires_at > ?
+        ORDER BY RANDOM();
+        """, (name.lower(), rtype, now)))
+
+    def lookup_delegates(self, zone: str, now: int) -> List[Tuple[bytes, int]]:
+        return list(self._conn.execute("""
+        SELECT DISTINCT a_data.data, min(ns_data.expires_at, a_data.expires_at)
+        FROM cache ns_data
+        JOIN cache a_data ON a_data.name = ns_data.ns and a_data.type = ?
+        WHERE ns_data.name = ?
+            and ns_data.type = ?
+            and ns_data.expires_at > ?
+            and a_data.expires_at > ?
+        ORDER BY RANDOM();
+        """, (A, zone.lower(), NS, now, now)))
+
+    def load_answers(self, now: int, limit: int) -> List[Tuple[str, int, List[Tuple[bytes, int]]]]:
+        # unexpired (name, type) entries, the most recently written `limit` of them first
+        entries = {}
+        for name, rtype, data, expires_at in self._conn.execute("""
+        SELECT name, type, data, expires_at
+        FROM cache
+        WHERE expires_at > ?
+        ORDER BY insertion_time DESC;
+        """, (now,)):
+            rows = entries.get((name, rtype))
+            if rows is None:
+                if len(entries) >= limit:
+                    break
+                rows = entries[(name, rtype)] = []
+            rows.append((data, expires_at))
+        return [(name, rtype, rows) for (name, rtype), rows in entries.items()]
+
+    def load_delegations(self, now: int) -> List[Tuple[bytes, int]]:
+        # unexpired NS records and the addresses of their nameservers
+        return list(self._conn.execute("""
+        SELECT data, expires_at
+        FROM cache
+        WHERE type = ? and expires_at > ?
+        UNION ALL
+        SELECT data, expires_at
+        FROM cache
+        WHERE type IN (?, ?)
+            and expires_at > ?
+            and name IN (SELECT ns FROM cache WHERE type = ? and expires_at > ?);
+        """, (NS, now, A, AAAA, now, NS, now)))
+
+    def sweep(self, now: int) -> int:
+        with self._conn:
+            return self._conn.execute("""
+            DELETE FROM cache
+            WHERE expires_at <= ?;
+            """, (now,)).rowcount
+
+
+class CacheWriteQueue:
+    # records wait here until a batch is taken for writing, lookup() finds them in the queued and in the
+    # taken batches until the batch is committed, so nothing has to be flushed before it can be read back
+    def __init__(self, max_size=256, flush_interval=1.0):
+        self._max_size = max_size
+        self._flush_interval = flush_interval
+        self._pending = {}  # (name, type) -> {rdata: (record, insertion_time)}
+        self._size = 0
+        self._writing = []  # taken batches, oldest first
+        self._oldest = None
+
+    def add(self, records: Iterable[DNSRecord], now: int):
+        for record in records:
+            rrset = self._pending.setdefault((record.rname.lower(), record.rtype), {})
+            self._size += record.rdata not in rrset
+            rrset[record.rdata] = (record, now)
+
+        if self._pending and self._oldest is None:
+            self._oldest = time.monotonic()
+
+    def full(self) -> bool:
+        return self._size >= self._max_size
+
+    def due(self) -> bool:
+        return self.full() or self._oldest is not None and time.monotonic() - self._oldest >= self._flush_interval
+
+    def take(self) -> Optional[dict]:
+        if not self._pending:
+            return None
+
+        batch = self._pending
+        self._pending = {}
+        self._size = 0
+        self._oldest = None
+        self._writing.append(batch)
+        return batch
+
+    def done(self, batch: dict):
+        self._writing.remove(batch)
+
+    @staticmethod
+    def rows(batch: dict) -> List[Tuple[DNSRecord, int]]:
+        return [row for rrset in batch.values() for row in rrset.values()]
+
+    def lookup(self, name: str, rtype: int, now: int) -> List[Tuple[bytes, int]]:
+        # the most recently queued records of (name, type), in the rows format of CacheStorage.lookup_answer
+        key = (name.lower(), rtype)
+        for batch in [self._pending] + self._writing[::-1]:
+            rrset = batch.get(key)
+            if rrset:
+                return [
+                    (record.to_bytes(), inserted + record.ttl)
+                    for record, inserted in rrset.values()
+                    if inserted + record.ttl > now
+                ]
+        return []
+
+    def __len__(self):
+        return self._size + sum(len(rrset) for batch in self._writing for rrset in batch.values())
@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import struct
+import time
+from main.messages import DNSMessage, TC
+from main.utils import read_tcp_message, write_tcp_message
+from main.constants import *
+
+
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    def __init__(self, query: bytes, response: asyncio.Future):
+        self._query = query
+        self._response = response
+
+    def datagram_received(self, data, addr):
+        # drop anything that doesn't echo our ID and question, e.g. late replies or spoofing attempts
+        if len(data) < 12 or data[:2] != self._query[:2]:
+            logging.debug('[{}] ignoring unexpected datagram from {}'.format(self.__class__.__name__, addr))
+            return
+        question_length = len(self._query) - 12
+        if data[12:12 + question_length].lower() != self._query[12:].lower():
+            logging.debug('[{}] ignoring datagram for another question from {}'.format(self.__class__.__name__,
+                                                                                      addr))
+            return
+
+        if not self._response.done():
+            self._response.set_result(data)
+
+    def error_received(self, exc):
+        if not self._response.done():
+            self._response.set_exception(exc)
+
+
+class PooledConnection:
+    def __init__(self, ip, reader, writer):
+        self.ip = ip
+        self._reader = reader
+        self._writer = writer
+        self._waiting = {}  # DNS ID -> future of the response
+        self.created_at = self.last_used = time.monotonic()
+        self.closed = False
+        self._reader_task = asyncio.ensure_future(self._read_responses())
+
+    async def _read_responses(self):
+        try:
+            while True:
+                data = await read_tcp_message(self._reader)
+                future = self._waiting.pop(data[:2], None)
+                if future is not None and not future.done():
+                    future.set_result(data)
+        except Exception as e:
+            logging.debug('[{}] connection to {} is done: {}'.format(self.__class__.__name__, self.ip, e))
+        finally:
+            self.close()
+
+    @property
+    def in_flight(self):
+        return len(self._waiting)
+
+    async def query(self, data: bytes) -> bytes:
+        key = data[:2]
+        if key in self._waiting:
+            raise Exception('Query ID is already in flight on connection to {}'.format(self.ip))
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[key] = future
+        try:
+            await write_tcp_message(self._writer, data)
+            return await future
+        finally:
+            self._waiting.pop(key, None)
+            self.last_used = time.monotonic()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._writer.close()
+        for future in self._waiting.values():
+            if not future.done():
+                future.set_exception(ConnectionError('Connection to {} closed'.format(self.ip)))
+        self._waiting.clear()
+        if self._reader_task is not asyncio.current_task():
+            self._reader_task.cancel()
+
+
+class TCPConnectionPool:
+    def __init__(self, port=53, idle_timeout=10.0, max_lifetime=120.0):
+        self._port = port
+        self._idle_timeout = idle_timeout
+        self._max_lifetime = max_lifetime
+        self._connections = {}  # ip -> [PooledConnection]
+        self.opened = 0
+        self.reused = 0
+        self.evicted = 0
+
+    def _usable(self, connection: PooledConnection, now):
+        return not connection.closed and now - connection.created_at < self._max_lifetime
+
+    async def query(self, data: bytes, ip) -> bytes:
+        now = time.monotonic()
+        usable = [c for c in self._connections.get(ip, []) if self._usable(c, now)]
+        if usable:
+            # pipeline onto the least busy connection
+            connection = min(usable, key=lambda c: c.in_flight)
+            self.reused += 1
+            try:
+                return await connection.query(data)
+            except ConnectionError:
+                # the server may have closed it while idle, retry once on a fresh connection
+                logging.debug('[{}] reused connection to {} failed, reopening'.format(self.__class__.__name__, ip))
+
+        connection = await self._open(ip)
+        return await connection.query(data)
+
+    async def _open(self, ip) -> PooledConnection:
+        reader, writer = await asyncio.open_connection(ip, self._port)
+        connection = PooledConnection(ip, reader, writer)
+        self._connections.setdefault(ip, []).append(connection)
+        self.opened += 1
+        return connection
+
+    def evict(self):
+        now = time.monotonic()
+        for ip, connections in list(self._connections.items()):
+            alive = []
+            for connection in connections:
+                expired = (now - connection.last_used >= self._idle_timeout
+                           or now - connection.created_at >= self._max_lifetime)
+                if connection.closed or (expired and not connection.in_flight):
+                    connection.close()
+                    self.evicted += 1
+                else:
+                    alive.append(connection)
+            if alive:
+                self._connections[ip] = alive
+            else:
+                del self._connections[ip]
+
+    def close(self):
+        for connections in self._connections.values():
+            for connection in connections:
+                connection.close()
+        self._connections = {}
+
+    def stats(self) -> dict:
+        return {
+            'open': sum(len(connections) for connections in self._connections.values()),
+            'opened': self.opened,
+            'reused': self.reused,
+            'evicted': self.evicted,
+        }
+
+
+class UpstreamTransport:
+    def __init__(self, port=53, edns_buffer_size=1232, tcp_idle_timeout=10.0, tcp_max_lifetime=120.0):
+        self._port = port
+        self._edns_buffer_size = edns_buffer_size
+        self.tcp_pool = TCPConnectionPool(port, tcp_idle_timeout, tcp_max_lifetime)
+
+    async def query(self, request: DNSMessage, ip, timeout=5.0) -> bytes:
+        question = request.to_bytes()
+        if self._edns_buffer_size:
+            request = request.with_edns(self._edns_buffer_size)
+
+        data = await asyncio.wait_for(self._query_udp(request.to_bytes(), question, ip), timeout)
+        if self._edns_buffer_size and data[3] & 0xF in {FORMATERROR, NOTIMPLEMENTED}:
+            # RFC 6891 section 7: the server may not understand OPT, ask once more without it
+            logging.debug('Response code %s from %s, retrying without EDNS', data[3] & 0xF, ip)
+            data = await asyncio.wait_for(self._query_udp(question, question, ip), timeout)
+        if struct.unpack('!H', data[2:4])[0] & TC:
+            logging.debug('Truncated response from %s, retrying over TCP', ip)
+            data = await asyncio.wait_for(self._query_tcp(question, ip), timeout)
+        return data
+
+    async def _query_udp(self, data: bytes, question: bytes, ip) -> bytes:
+        loop = asyncio.get_running_loop()
+        response = loop.create_future()
+        # the socket is connected, so the kernel only delivers datagrams from ip:port
+        # to the ephemeral source port it picked at random
+        transport, _ = await loop.create_datagram_endpoint(lambda: UpstreamProtocol(question, response),
+                                                           remote_addr=(ip, self._port))
+        try:
+            transport.sendto(data)
+            return await response
+        finally:
+            transport.close()
+
+    async def _query_tcp(self, data: bytes, ip) -> bytes:
+        # responses are matched to queries by ID inside the pooled connection
+        return await self.tcp_pool.query(data, ip)
+
+    def close(self):
+        self.tcp_pool.close()
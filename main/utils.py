@@ -1,58 +1,127 @@
+import socket
 import struct
+from typing import Optional
 
 
-def parse_name(data, i):
-    result = ''
+def parse_name(data, i, names=None):
+    # works on bytes or memoryview, labels are sliced out instead of being copied char by char;
+    # `names` maps offsets of already decoded names to the name, so repeated pointers are cheap.
+    # Only the first label of every run of labels is added, a pointer into the middle of a run
+    # walks the labels once and adds its target
+    labels = []
+    starts = []  # (offset, index in labels) of the first label of every run
+    suffix = ''
+    end = None
+    segment_start = i
 
-    while data[i] != 0:
-        letters_count = data[i]
-        i += 1
-
-        if (letters_count & 0xC0) == 0xC0:
-            # first 2 bits are set
-            offset = letters_count ^ 0xC0
-            offset <<= 8
-            offset += data[i]
+    while True:
+        length = data[i]
+        if length == 0:
             i += 1
+            break
 
-            result += parse_name(data, offset)[0]
-            return result, i
+        if (length & 0xC0) == 0xC0:
+            # first 2 bits are set, the rest of the name lives at the offset
+            offset = ((length & 0x3F) << 8) | data[i + 1]
+            if end is None:
+                end = i + 2
+            if offset >= segment_start:
+                # pointers may only go backwards, which also rules out loops
+                raise ValueError('Bad compression pointer to {} at {}'.format(offset, i))
+            if names is not None and offset in names:
+                suffix = names[offset]
+                break
+            i = segment_start = offset
         else:
-            for _ in range(letters_count):
-                result += chr(data[i])
-                i += 1
-            result += '.'
-    if not result:
-        result = '.'
-    i += 1
+            if i == segment_start:
+                starts.append((i, len(labels)))
+            labels.append(data[i + 1:i + 1 + length])
+            i += 1 + length
+
+    if end is None:
+        end = i
 
-    return result, i
+    if not labels:
+        return suffix or '.', end
 
+    name = b'.'.join(labels).decode('latin-1') + '.' + suffix
+    if names is not None:
+        for position, k in starts:
+            names[position] = name[sum(map(len, labels[:k])) + k:] if k else name
+    return name, end
 
-def encode_name(name) -> bytes:
+
+def encode_name(name, compression=None, offset=0) -> bytes:
+    # `compression` maps lowercased name suffixes to their offset in the message being built,
+    # `offset` is where this name will be written; known suffixes become RFC 1035 pointers
     if name == '.':
-        return chr(0).encode()
+        return b'\x00'
+
+    # latin-1 like parse_name, so label bytes >= 0x80 come back as they were received
+    parts = name.encode('latin-1').split(b'.')
+    if parts[-1]:
+        parts.append(b'')
 
     result = b''
-    for part in name.encode().split(b'.'):
-        result += chr(len(part)).encode()
-        result += part
-    return result
+    for k in range(len(parts) - 1):
+        if compression is not None:
+            suffix = b'.'.join(parts[k:]).lower()
+            pointer = compression.get(suffix)
+            if pointer is not None:
+                return result + struct.pack('!H', 0xC000 | pointer)
+            if offset + len(result) < 0x4000:
+                compression[suffix] = offset + len(result)
 
+        result += bytes((len(parts[k]),)) + parts[k]
+    return result + b'\x00'
 
-def recv_tcp_message(conn):
-    result = b''
-    length = conn.recv(2)
-    length = struct.unpack('!H', length)[0]
+
+def _recv_exactly(conn, length) -> bytes:
+    result = bytearray()
     while len(result) < length:
-        data = conn.recv(length - len(result))
+        try:
+            data = conn.recv(length - len(result))
+        except socket.timeout:
+            # part of the message is consumed already, the stream can't be resumed
+            raise ConnectionError('Timed out after {} of {} bytes'.format(len(result), length))
+        if not data:
+            raise ConnectionError('Connection closed after {} of {} bytes'.format(len(result), length))
         result += data
+    return bytes(result)
 
-        if not data:
-            break
-    return result
+
+def recv_tcp_message(conn, message_timeout=None) -> Optional[bytes]:
+    # None when the peer closed the connection between two messages, a socket timeout is only
+    # raised while nothing of the next message has been read; once it started, the rest of the
+    # message may take message_timeout instead of the socket's timeout
+    length = conn.recv(2)
+    if not length:
+        return None
+
+    timeout = conn.gettimeout()
+    if message_timeout is not None:
+        conn.settimeout(message_timeout)
+    try:
+        if len(length) == 1:
+            length += _recv_exactly(conn, 1)
+        return _recv_exactly(conn, struct.unpack('!H', length)[0])
+    finally:
+        if message_timeout is not None:
+            conn.settimeout(timeout)
 
 
 def send_tcp_message(conn, data):
     data_length = struct.pack('!H', len(data))
     conn.sendall(data_length + data)
+
+
+async def read_tcp_message(reader):
+    length = await reader.readexactly(2)
+    length = struct.unpack('!H', length)[0]
+    return await reader.readexactly(length)
+
+
+async def write_tcp_message(writer, data):
+    data_length = struct.pack('!H', len(data))
+    writer.write(data_length + data)
+    await writer.drain()
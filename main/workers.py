@@ -0,0 +1,120 @@
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+
+
+# gauges that aren't summed over the workers: a server's RTT estimates are averaged, the holddown and
+# the size of the shared cache file, which every worker sees, take the largest value
+AVERAGED_STATS = {'srtt_ms', 'rttvar_ms', 'timeout_ms'}
+MAXIMUM_STATS = {'held_for', 'slots'}
+
+
+def aggregate_stats(stats: list) -> dict:
+    # sums the counters of every worker, nested sections are aggregated key by key
+    values = {}
+    for s in stats:
+        for key, value in s.items():
+            if isinstance(value, (dict, int, float)) and not isinstance(value, bool):
+                values.setdefault(key, []).append(value)
+
+    total = {}
+    for key, numbers in values.items():
+        if isinstance(numbers[0], dict):
+            total[key] = aggregate_stats([n for n in numbers if isinstance(n, dict)])
+        elif key in AVERAGED_STATS:
+            total[key] = round(sum(numbers) / len(numbers), 1)
+        elif key in MAXIMUM_STATS:
+            total[key] = max(numbers)
+        else:
+            total[key] = sum(numbers)
+    return total
+
+
+class StatsReporter(threading.Thread):
+    def __init__(self, index, stats_queue, get_stats, interval):
+        super().__init__(daemon=True)
+        self._index = index
+        self._stats_queue = stats_queue
+        self._get_stats = get_stats
+        self._interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self._interval)
+            try:
+                self._stats_queue.put((self._index, self._get_stats()))
+            except Exception as e:
+                logging.warning("Error with stats report: `{}`, will continue w/o it".format(e))
+
+
+def _run_worker(index, target, stats_queue, stats_interval):
+    # Ctrl-C reaches the whole process group, leave it to the parent to stop the workers;
+    # SIGTERM then runs the worker's own KeyboardInterrupt handling, which flushes the cache
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    # stats that didn't reach the parent yet are dropped on exit, waiting for the pipe could block forever
+    stats_queue.cancel_join_thread()
+    logging.info('[Worker {}] started'.format(index))
+    target(lambda get_stats: StatsReporter(index, stats_queue, get_stats, stats_interval).start())
+
+
+class WorkerPool:
+    def __init__(self, target, count, stats_interval=10.0):
+        # target(report_stats) serves clients until interrupted and hands its stats getter to report_stats
+        self._target = target
+        self._count = count
+        self._stats_interval = stats_interval
+        self._context = multiprocessing.get_context('fork')
+        self._stats_queue = self._context.Queue()
+        self._workers = {}  # index -> Process
+        self.stats = {}  # index -> latest stats reported by the worker
+
+    def _spawn(self, index):
+        process = self._context.Process(target=_run_worker, name='worker-{}'.format(index),
+                                        args=(index, self._target, self._stats_queue, self._stats_interval))
+        process.start()
+        self._workers[index] = process
+
+    def start(self):
+        for index in range(self._count):
+            self._spawn(index)
+
+    def supervise(self):
+        last_report = time.monotonic()
+        while True:
+            try:
+                index, stats = self._stats_queue.get(timeout=1)
+                self.stats[index] = stats
+            except queue.Empty:
+                pass
+
+            for index, process in list(self._workers.items()):
+                if not process.is_alive():
+                    logging.warning('[{}] worker {} exited with `{}`, restarting'.format(
+                        self.__class__.__name__, index, process.exitcode))
+                    self.stats.pop(index, None)
+                    self._spawn(index)
+
+            if time.monotonic() - last_report >= self._stats_interval and self.stats:
+                last_report = time.monotonic()
+                logging.debug('[%s] stats of %s workers: %s',
+                              self.__class__.__name__, len(self.stats), self.aggregated_stats())
+
+    def aggregated_stats(self) -> dict:
+        return aggregate_stats(list(self.stats.values()))
+
+    def stop(self, timeout=10.0):
+        for process in self._workers.values():
+            process.terminate()
+        deadline = time.monotonic() + timeout
+        for index, process in self._workers.items():
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.warning('[{}] worker {} did not stop in {}s, killing it'.format(
+                    self.__class__.__name__, index, timeout))
+                process.kill()
+                process.join()
+        self._workers = {}
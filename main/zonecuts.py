@@ -0,0 +1,153 @@
+import time
+from typing import List, Optional, Tuple
+
+
+def _labels(name: str) -> List[str]:
+    # 'www.Example.com.' -> ['com', 'example', 'www']
+    return [label for label in reversed(name.lower().split('.')) if label]
+
+
+class _Node:
+    __slots__ = ('children', 'nameservers')
+
+    def __init__(self):
+        self.children = {}
+        self.nameservers = {}  # NS name -> expires_at, empty unless the node is a zone cut
+
+
+class ZoneCutCache:
+    # Zone cuts kept in a trie of reversed labels, so the deepest known delegation of a name is found
+    # in one walk, plus the addresses of the nameservers shared by every zone they serve
+    def __init__(self, unresolvable_ttl=60):
+        self._root = _Node()
+        self._addresses = {}  # NS name -> {ip: expires_at}
+        self._nameservers = {}  # NS name -> latest expiry among the zones it serves
+        self._unresolvable = {}  # NS name -> until when its address lookups are not retried
+        self._unresolvable_ttl = unresolvable_ttl
+        self.lookups = 0
+        self.hits = 0
+
+    def _node(self, zone: str, create=False) -> Optional[_Node]:
+        node = self._root
+        for label in _labels(zone):
+            child = node.children.get(label)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[label] = _Node()
+            node = child
+        return node
+
+    def add_delegation(self, zone: str, nameserver: str, ttl: int):
+        nameserver = nameserver.lower()
+        expires_at = time.time() + ttl
+        self._node(zone, create=True).nameservers[nameserver] = expires_at
+        self._nameservers[nameserver] = max(expires_at, self._nameservers.get(nameserver, 0))
+
+    def add_address(self, nameserver: str, ip: str, ttl: int):
+        nameserver = nameserver.lower()
+        self._addresses.setdefault(nameserver, {})[ip] = time.time() + ttl
+        self._unresolvable.pop(nameserver, None)
+
+    def is_nameserver(self, name: str) -> bool:
+        return self._nameservers.get(name.lower(), 0) > time.time()
+
+    def mark_unresolvable(self, nameserver: str, ttl: Optional[int] = None):
+        self._unresolvable[nameserver.lower()] = time.time() + (ttl if ttl is not None else self._unresolvable_ttl)
+
+    def is_unresolvable(self, nameserver: str) -> bool:
+        until = self._unresolvable.get(nameserver.lower())
+        return until is not None and until > time.time()
+
+    def _live_addresses(self, nameserver, now) -> List[str]:
+        return [ip for ip, expires_at in self._addresses.get(nameserver, {}).items() if expires_at > now]
+
+    def find(self, qname: str) -> Optional[Tuple[str, List[Tuple[str, str]]]]:
+        # the deepest zone above qname with live NS records that have a known address
+        now = time.time()
+        self.lookups += 1
+        found = None
+        node = self._root
+        zone = []
+        for label in [None] + _labels(qname):
+            if label is not None:
+                node = node.children.get(label)
+                if node is None:
+                    break
+                zone.insert(0, label)
+
+            servers = self._servers(node, now)
+            if servers:
+                found = ('.'.join(zone) + '.', servers)
+
+        if found is None:
+            return None
+        self.hits += 1
+        return found
+
+    def _servers(self, node: _Node, now) -> List[Tuple[str, str]]:
+        return [
+            (nameserver, ip)
+            for nameserver, expires_at in node.nameservers.items() if expires_at > now
+            for ip in self._live_addresses(nameserver, now)
+        ]
+
+    def servers(self, zone: str) -> List[Tuple[str, str]]:
+        # (NS name, ip) known for exactly this zone
+        node = self._node(zone)
+        return self._servers(node, time.time()) if node is not None else []
+
+    def missing_addresses(self, zone: str) -> List[str]:
+        # live nameservers of the zone without a known address that are worth looking up
+        node = self._node(zone)
+        if node is None:
+            return []
+        now = time.time()
+        return [
+            nameserver
+            for nameserver, expires_at in node.nameservers.items()
+            if expires_at > now and not self._live_addresses(nameserver, now) and not self.is_unresolvable(nameserver)
+        ]
+
+    def prune(self) -> int:
+        now = time.time()
+        removed = 0
+
+        def walk(node):
+            nonlocal removed
+            for nameserver in [n for n, expires_at in node.nameservers.items() if expires_at <= now]:
+                del node.nameservers[nameserver]
+                removed += 1
+            for label, child in list(node.children.items()):
+                walk(child)
+                if not child.children and not child.nameservers:
+                    del node.children[label]
+        walk(self._root)
+
+        for nameserver, addresses in list(self._addresses.items()):
+            for ip in [ip for ip, expires_at in addresses.items() if expires_at <= now]:
+                del addresses[ip]
+                removed += 1
+            if not addresses:
+                del self._addresses[nameserver]
+        for nameserver in [n for n, until in self._unresolvable.items() if until <= now]:
+            del self._unresolvable[nameserver]
+        for nameserver in [n for n, expires_at in self._nameservers.items() if expires_at <= now]:
+            del self._nameservers[nameserver]
+        return removed
+
+    def stats(self) -> dict:
+        zones = 0
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            zones += bool(node.nameservers)
+            stack.extend(node.children.values())
+        return {
+            'zones': zones,
+            'nameservers': len(self._nameservers),
+            'nameservers_with_addresses': len(self._addresses),
+            'unresolvable_nameservers': len(self._unresolvable),
+            'lookups': self.lookups,
+            'hits': self.hits,
+        }
@@ -0,0 +1,109 @@
+import unittest
+from unittest import mock
+from main.cache import NegativeCache, WireAnswerCache
+from main.messages import DNSHeader, DNSMessage, DNSQuestion, DNSRecord, QR, RA, RD
+from main.utils import encode_name
+from main.constants import *
+
+NOW = 1000000.0
+
+
+def _request(qname, id=0x1234, flags=RD):
+    return DNSMessage(DNSHeader(id=id, flags=flags, qdcount=1, ancount=0, nscount=0, arcount=0),
+                      questions=[DNSQuestion(qname, A, 1)],
+                      answers=[], authorities=[], additionals=[]).to_bytes()
+
+
+def _cache():
+    cache = WireAnswerCache()
+    answers = [
+        DNSRecord('www.example.com.', CNAME, 1, 300, len(encode_name('web.example.com.')), b'web.example.com.'),
+        DNSRecord('web.example.com.', A, 1, 60, 4, bytes([192, 0, 2, 1])),
+    ]
+    with mock.patch('time.time', return_value=NOW):
+        cache.put(DNSQuestion('www.example.com.', A, 1), answers)
+    return cache
+
+
+def _get(cache, request, now=NOW):
+    with mock.patch('time.time', return_value=now):
+        return cache.get_response(request, DNSMessage.parse(request)[0].questions[0].qname, A, len(request))
+
+
+class WireAnswerCacheTest(unittest.TestCase):
+    def test_miss(self):
+        self.assertIsNone(_get(_cache(), _request('mail.example.com.')))
+
+    def test_id_and_flags_from_request(self):
+        for flags in (0, RD):
+            request = _request('www.example.com.', id=0xBEEF, flags=flags)
+            response, _ = DNSMessage.parse(_get(_cache(), request))
+            self.assertEqual(response.header.id, 0xBEEF)
+            self.assertEqual(response.header.flags, flags | QR | RA | NOERROR)
+            self.assertEqual((response.header.qdcount, response.header.ancount), (1, 2))
+
+    def test_ttls_count_down(self):
+        cache = _cache()
+        response, _ = DNSMessage.parse(_get(cache, _request('www.example.com.'), NOW + 20.5))
+        self.assertEqual([r.ttl for r in response.answers], [279, 39])
+        self.assertEqual(response.answers[1].as_ip(), '192.0.2.1')
+        # the stored bytes are left alone
+        response, _ = DNSMessage.parse(_get(cache, _request('www.example.com.')))
+        self.assertEqual([r.ttl for r in response.answers], [300, 60])
+
+    def test_expires_with_shortest_ttl(self):
+        self.assertIsNone(_get(_cache(), _request('www.example.com.'), NOW + 60))
+
+    def test_qname_case(self):
+        request = _request('WWW.Example.COM.')
+        data = _get(_cache(), request)
+        self.assertIsNotNone(data)
+        # the question is echoed as asked, the answers still decode through pointers into it
+        self.assertEqual(data[12:len(request)], request[12:])
+        response, _ = DNSMessage.parse(data)
+        self.assertEqual(response.questions[0].qname, 'WWW.Example.COM.')
+        self.assertEqual([r.rtype for r in response.answers], [CNAME, A])
+        self.assertEqual(response.answers[0].rname.lower(), 'www.example.com.')
+        self.assertEqual(response.answers[1].as_ip(), '192.0.2.1')
+
+
+
+class NegativeCacheTest(unittest.TestCase):
+    def _get(self, cache, name, rtype, now=NOW):
+        with mock.patch('time.time', return_value=now):
+            return cache.get(name, rtype)
+
+    def _cache(self, nxdomain_ttl=None, nodata_ttl=None):
+        cache = NegativeCache()
+        with mock.patch('time.time', return_value=NOW):
+            if nxdomain_ttl is not None:
+                cache.put_nxdomain('Missing.Example.', nxdomain_ttl)
+            if nodata_ttl is not None:
+                cache.put_nodata('missing.example.', AAAA, nodata_ttl)
+        return cache
+
+    def test_nxdomain_covers_every_type(self):
+        cache = self._cache(nxdomain_ttl=60)
+        for rtype in (A, AAAA, NS):
+            self.assertEqual(self._get(cache, 'missing.EXAMPLE.', rtype), NAMEERROR)
+
+    def test_nodata_is_per_type(self):
+        cache = self._cache(nodata_ttl=60)
+        self.assertEqual(self._get(cache, 'missing.example.', AAAA), NOERROR)
+        self.assertIsNone(self._get(cache, 'missing.example.', A))
+
+    def test_expiry(self):
+        cache = self._cache(nxdomain_ttl=60)
+        self.assertEqual(self._get(cache, 'missing.example.', A, NOW + 59), NAMEERROR)
+        self.assertIsNone(self._get(cache, 'missing.example.', A, NOW + 60))
+
+    def test_nodata_behind_expired_nxdomain(self):
+        cache = self._cache(nxdomain_ttl=30, nodata_ttl=300)
+        self.assertEqual(self._get(cache, 'missing.example.', AAAA, NOW + 10), NAMEERROR)
+        self.assertEqual(self._get(cache, 'missing.example.', AAAA, NOW + 100), NOERROR)
+        self.assertIsNone(self._get(cache, 'missing.example.', A, NOW + 100))
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
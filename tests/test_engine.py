@@ -0,0 +1,203 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from main.engine import ResolutionEngine
+from main.messages import DNSHeader, DNSMessage, DNSQuestion, DNSRecord, QR, RD
+from main.selection import ServerSelector
+from main.utils import encode_name
+from main.constants import *
+
+
+def _ns(zone, nameserver, ttl=3600):
+    return DNSRecord(zone, NS, 1, ttl, len(encode_name(nameserver)), nameserver.encode())
+
+
+def _a(name, address, ttl=300):
+    return DNSRecord(name, A, 1, ttl, 4, bytes(map(int, address.split('.'))))
+
+
+def _referral(qname, zone, nameservers):
+    authorities = [_ns(zone, nameserver) for nameserver in nameservers]
+    return DNSMessage(DNSHeader(id=1, flags=0x8000, qdcount=1, ancount=0, nscount=len(authorities), arcount=0),
+                      questions=[DNSQuestion(qname, A, 1)],
+                      answers=[], authorities=authorities, additionals=[])
+
+
+class EngineTestCase(unittest.TestCase):
+    ENGINE_OPTIONS = {}
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = ResolutionEngine(['192.0.2.1'], os.path.join(self.directory.name, 'cache.db'),
+                                       **self.ENGINE_OPTIONS)
+        self.engine.cache.open()
+
+    def tearDown(self):
+        self.engine.cache.close()
+        # the writer's connection belongs to its thread
+        self.engine._cache_writes.submit(self.engine.cache_writer.close).result()
+        self.engine._cache_writes.shutdown()
+        self.directory.cleanup()
+
+
+class LossyTransport:
+    # answers for every server in `answers`, the first `lost` queries are never answered
+    def __init__(self, answers, lost=0):
+        self.answers = answers
+        self.lost = lost
+        self.queries = []
+
+    async def query(self, request, ip, timeout):
+        self.queries.append(ip)
+        if len(self.queries) <= self.lost:
+            await asyncio.sleep(timeout)
+            raise asyncio.TimeoutError()
+        response = request.with_rcode(self.answers[ip]).as_response()
+        if self.answers[ip] == NOERROR:
+            response.answers = [_a(request.questions[0].qname, '192.0.2.80')]
+            response.header.ancount = 1
+        return response.to_bytes()
+
+
+class ProbeStaggeredTest(EngineTestCase):
+    ENGINE_OPTIONS = {'stagger_delay': 0.01, 'query_timeout': 1.0}
+
+    def _probe(self, transport, servers):
+        self.engine.transport.query = transport.query
+        return asyncio.run(self.engine.probe_staggered(DNSQuestion('www.example.com.', A, 1), servers))
+
+    def test_lost_datagram_is_retried(self):
+        transport = LossyTransport({'192.0.2.53': NOERROR}, lost=1)
+        response, failure = self._probe(transport, [('ns1.example.com.', '192.0.2.53')])
+        self.assertIsNone(failure)
+        self.assertEqual(response.answers[0].as_ip(), '192.0.2.80')
+        self.assertEqual(transport.queries, ['192.0.2.53', '192.0.2.53'])
+
+    def test_failure_is_not_retried(self):
+        transport = LossyTransport({'192.0.2.53': REFUSED, '192.0.2.54': SERVERFAILURE})
+        response, failure = self._probe(transport, [('ns1.example.com.', '192.0.2.53'),
+                                                    ('ns2.example.com.', '192.0.2.54')])
+        self.assertIsNone(response)
+        self.assertEqual(failure, SERVERFAILURE)
+        self.assertEqual(sorted(transport.queries), ['192.0.2.53', '192.0.2.54'])
+
+    def test_silent_until_the_deadline(self):
+        self.engine.selector = ServerSelector(max_timeout=0.05)
+        transport = LossyTransport({}, lost=100)
+        started = time.monotonic()
+        response, failure = self._probe(transport, [('ns1.example.com.', '192.0.2.53')])
+        self.assertEqual((response, failure), (None, SERVERFAILURE))
+        self.assertLess(time.monotonic() - started, 1.5)
+        # 0.01s, then 0.02, 0.04... apart
+        self.assertGreater(len(transport.queries), 3)
+
+
+class CachedResponseTest(EngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.engine.wire_cache.put(DNSQuestion('www.example.com.', A, 1), [_a('www.example.com.', '192.0.2.80')])
+
+    def _request(self, qclass=1, flags=RD):
+        return DNSMessage(DNSHeader(id=7, flags=flags, qdcount=1, ancount=0, nscount=0, arcount=0),
+                          questions=[DNSQuestion('www.example.com.', A, qclass)],
+                          answers=[], authorities=[], additionals=[]).to_bytes()
+
+    def test_query(self):
+        response, _ = DNSMessage.parse(self.engine.cached_response(self._request()))
+        self.assertEqual(response.answers[0].as_ip(), '192.0.2.80')
+
+    def test_other_class(self):
+        # CH
+        request = self._request(qclass=3)
+        self.assertIsNone(self.engine.cached_response(request))
+        response, _ = DNSMessage.parse(asyncio.run(self.engine.resolve_uncached(request)))
+        self.assertEqual(response.header.rcode(), NOTIMPLEMENTED)
+
+    def test_other_opcode(self):
+        # STATUS
+        request = self._request(flags=2 << 11 | RD)
+        self.assertIsNone(self.engine.cached_response(request))
+        response, _ = DNSMessage.parse(asyncio.run(self.engine.resolve_uncached(request)))
+        self.assertEqual(response.header.rcode(), NOTIMPLEMENTED)
+        self.assertEqual(response.answers, [])
+
+    def test_response(self):
+        self.assertIsNone(self.engine.cached_response(self._request(flags=QR | RD)))
+
+
+class CacheWriteTest(EngineTestCase):
+    ENGINE_OPTIONS = {'cache_write_batch_size': 2}
+
+    async def _insert(self, records):
+        self.engine._loop = asyncio.get_running_loop()
+        self.engine._insert_cache(records)
+        # the second record fills the batch, which goes to the writer thread
+        while len(self.engine.write_queue):
+            await asyncio.sleep(0.01)
+
+    def test_flushed_when_full(self):
+        records = [_a('www.example.com.', '192.0.2.1'), _a('www.example.com.', '192.0.2.2')]
+        asyncio.run(self._insert(records))
+        rows = self.engine.cache.lookup_answer('www.example.com.', A, int(time.time()))
+        self.assertEqual(sorted(DNSRecord.parse(data, 0)[0].as_ip() for data, _ in rows), ['192.0.2.1', '192.0.2.2'])
+
+    def test_failed_write_is_dropped(self):
+        def fail(rows):
+            raise sqlite3.OperationalError('disk I/O error')
+        self.engine.cache_writer.insert_many = fail
+        records = [_a('www.example.com.', '192.0.2.1'), _a('www.example.com.', '192.0.2.2')]
+        with self.assertLogs(level='WARNING'):
+            asyncio.run(self._insert(records))
+        self.assertEqual(self.engine.cache.lookup_answer('www.example.com.', A, int(time.time())), [])
+        self.assertEqual(self.engine.write_queue.lookup('www.example.com.', A, int(time.time())), [])
+
+
+class GlueLookupTest(EngineTestCase):
+    def test_glue_from_answer_cache(self):
+        # a glue-less referral whose NS address is cached already is followed without asking upstream
+        referral = _referral('www.example.com.', 'example.com.', ['ns1.example.net.'])
+        self.engine._learn_zone_cuts(referral.authorities)
+        self.engine.answer_cache.put('ns1.example.net.', A, [_a('ns1.example.net.', '192.0.2.53')])
+
+        asyncio.run(self.engine.fill_missing_ns(referral, 0))
+        self.assertEqual(self.engine.zone_cuts.servers('example.com.'), [('ns1.example.net.', '192.0.2.53')])
+        self.assertEqual(self.engine.where_to_ask('www.example.com.'), [('ns1.example.net.', '192.0.2.53')])
+        self.assertEqual(self.engine.glue_resolved, 1)
+
+    def test_glue_not_found(self):
+        referral = _referral('www.example.com.', 'example.com.', ['ns1.example.net.'])
+        self.engine._learn_zone_cuts(referral.authorities)
+        self.engine.negative_cache.put_nxdomain('ns1.example.net.', 60)
+
+        asyncio.run(self.engine.fill_missing_ns(referral, 0))
+        self.assertEqual(self.engine.zone_cuts.servers('example.com.'), [])
+        self.assertTrue(self.engine.zone_cuts.is_unresolvable('ns1.example.net.'))
+        self.assertEqual(self.engine.glue_failed, 1)
+
+
+
+class WhereToAskTest(EngineTestCase):
+    def setUp(self):
+        super().setUp()
+        now = int(time.time())
+        self.engine.cache.insert_many([(_ns('example.com.', 'ns1.example.com.'), now),
+                                       (_a('ns1.example.com.', '192.0.2.53'), now)])
+        self.engine.zone_cuts.add_delegation('com.', 'a.gtld-servers.net.', 3600)
+        self.engine.zone_cuts.add_address('a.gtld-servers.net.', '192.0.2.30', 3600)
+
+    def test_deeper_cut_from_storage(self):
+        # only com. is in memory, e.g. after a restart, example.com. is in the cache file
+        self.assertEqual(self.engine.where_to_ask('www.example.com.'), [('ns1.example.com.', '192.0.2.53')])
+        # and is remembered in memory from then on
+        self.assertEqual(self.engine.zone_cuts.find('www.example.com.')[0], 'example.com.')
+
+    def test_cut_from_memory(self):
+        self.assertEqual(self.engine.where_to_ask('www.example.net.'), [('.', '192.0.2.1')])
+        self.assertEqual(self.engine.where_to_ask('www.other.com.'), [('a.gtld-servers.net.', '192.0.2.30')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+import random
+import struct
+import unittest
+from main.messages import DNSHeader, DNSMessage, DNSQuestion, DNSRecord, NAME_TYPES
+from main.utils import encode_name, parse_name
+from main.constants import *
+
+# what decoding a cut off or malformed message may raise
+PARSE_ERRORS = (ValueError, IndexError, struct.error)
+
+
+def _message(answers=(), authorities=(), additionals=()):
+    return DNSMessage(DNSHeader(id=1, flags=0x8180, qdcount=1, ancount=len(answers),
+                                nscount=len(authorities), arcount=len(additionals)),
+                      questions=[DNSQuestion('www.example.com.', A, 1)],
+                      answers=list(answers),
+                      authorities=list(authorities),
+                      additionals=list(additionals))
+
+
+def _response():
+    # compressed: owners point at the question, the glue owner at the NS target
+    ns = 'ns1.example.com.'
+    return _message(
+        answers=[DNSRecord('www.example.com.', A, 1, 300, 4, bytes([192, 0, 2, k])) for k in range(3)],
+        authorities=[DNSRecord('example.com.', NS, 1, 3600, len(encode_name(ns)), ns.encode())],
+        additionals=[DNSRecord(ns, A, 1, 3600, 4, bytes([192, 0, 2, 53]))],
+    )
+
+
+def _random_message(rng):
+    # names share labels and suffixes, so most of them get compressed
+    def name():
+        return '.'.join(rng.choice(['www', 'mail', 'ns1', 'a', 'b-c', 'x' * 63, 'caf\xe9', '\x80\xff'])
+                        for _ in range(rng.randrange(3))) + \
+            rng.choice(['.example.com.', '.example.net.', '.com.', '.arpa.'])
+
+    def record():
+        rtype = rng.choice([A, AAAA, NS, CNAME, PTR, 16])
+        if rtype in NAME_TYPES:
+            target = name().lstrip('.')
+            return DNSRecord(name().lstrip('.'), rtype, 1, rng.randrange(2 ** 31), len(encode_name(target)),
+                             target.encode('latin-1'))
+        rdata = bytes(rng.randrange(256) for _ in range({A: 4, AAAA: 16}.get(rtype, rng.randrange(40))))
+        return DNSRecord(name().lstrip('.'), rtype, 1, rng.randrange(2 ** 31), len(rdata), rdata)
+
+    sections = [[record() for _ in range(rng.randrange(6))] for _ in range(3)]
+    return DNSMessage(DNSHeader(id=rng.randrange(2 ** 16), flags=rng.randrange(2 ** 16), qdcount=1,
+                                ancount=len(sections[0]), nscount=len(sections[1]), arcount=len(sections[2])),
+                      questions=[DNSQuestion(name().lstrip('.'), rng.choice([A, AAAA, NS]), 1)],
+                      answers=sections[0],
+                      authorities=sections[1],
+                      additionals=sections[2])
+
+
+def _name_pointers(data, i):
+    while data[i]:
+        if data[i] >= 0xC0:
+            return [(i, (data[i] & 0x3F) << 8 | data[i + 1])], i + 2
+        i += data[i] + 1
+    return [], i + 1
+
+
+def _pointers(data):
+    # (position, target) of every compression pointer of the message
+    header, i = DNSHeader.parse(data, 0)
+    found = []
+    for _ in range(header.qdcount):
+        pointers, i = _name_pointers(data, i)
+        found += pointers
+        i += 4
+    for _ in range(header.ancount + header.nscount + header.arcount):
+        pointers, i = _name_pointers(data, i)
+        found += pointers
+        rtype, _, _, rdlength = struct.unpack_from('!HHIH', data, i)
+        i += 10
+        if rtype in NAME_TYPES:
+            found += _name_pointers(data, i)[0]
+        i += rdlength
+    return found
+
+
+class ParseNameTest(unittest.TestCase):
+    def test_pointer_to_itself(self):
+        data = bytes(12) + b'\xc0\x0c'
+        with self.assertRaises(ValueError):
+            parse_name(data, 12)
+
+    def test_pointer_loop(self):
+        # www -> pointer to its own label
+        data = bytes(12) + b'\x03www\xc0\x0c'
+        with self.assertRaises(ValueError):
+            parse_name(data, 12)
+
+    def test_forward_pointer(self):
+        data = bytes(12) + b'\xc0\x0e' + encode_name('example.com.')
+        with self.assertRaises(ValueError):
+            parse_name(data, 12)
+
+    def test_backward_pointer(self):
+        data = bytes(12) + encode_name('example.com.') + b'\x03www\xc0\x0c'
+        self.assertEqual(parse_name(data, 25), ('www.example.com.', 31))
+
+    def test_pointer_into_a_name(self):
+        # the target is the second label of an earlier name, which wasn't added to the table yet
+        data = bytes(12) + encode_name('www.example.com.') + b'\x04mail\xc0\x10'
+        names = {}
+        parse_name(data, 12, names)
+        self.assertEqual(parse_name(data, 29, names), ('mail.example.com.', 36))
+        self.assertEqual(names[16], 'example.com.')
+        self.assertEqual(names[29], 'mail.example.com.')
+
+    def test_names_from_offset_table(self):
+        data = bytes(12) + encode_name('www.example.com.') + b'\x04mail\xc0\x0c'
+        names = {12: 'cached.example.'}
+        self.assertEqual(parse_name(data, 29, names), ('mail.cached.example.', 36))
+
+    def test_label_bytes_above_0x7f(self):
+        data = bytes(12) + b'\x04caf\xe9\x03\x80\x81\xff\x00'
+        name, end = parse_name(data, 12)
+        self.assertEqual(end, len(data))
+        self.assertEqual(encode_name(name), data[12:])
+
+    def test_truncated_name(self):
+        data = bytes(12) + encode_name('www.example.com.')
+        for end in range(12, len(data)):
+            with self.assertRaises(PARSE_ERRORS):
+                parse_name(data[:end], 12)
+
+
+class DNSMessageParseTest(unittest.TestCase):
+    def test_records(self):
+        message = _response()
+        parsed, _ = DNSMessage.parse(message.to_bytes())
+        self.assertEqual(parsed.questions, message.questions)
+        self.assertEqual(list(parsed.records()), list(message.records()))
+
+    def test_names_reached_through_offset_table(self):
+        data = _response().to_bytes()
+        parsed, _ = DNSMessage.parse(data)
+        glue = parsed.additionals[0]
+        self.assertEqual(glue.rname, 'ns1.example.com.')
+        self.assertEqual(glue.as_ip(), '192.0.2.53')
+        # the same owners when every name is walked on its own
+        _, i = DNSMessage.parse(data)
+        for record in parsed.records():
+            walked, i = DNSRecord.parse(data, i)
+            self.assertEqual(walked, record)
+
+    def test_truncated(self):
+        data = _response().to_bytes()
+        for end in range(len(data)):
+            with self.assertRaises(PARSE_ERRORS):
+                message, _ = DNSMessage.parse(data[:end])
+                list(message.records())
+
+    def test_rdata_past_the_end(self):
+        data = bytearray(_response().to_bytes())
+        # RDLENGTH of the last record, the glue A
+        data[-6:-4] = struct.pack('!H', 5)
+        message, _ = DNSMessage.parse(bytes(data))
+        with self.assertRaises(ValueError):
+            message.additionals
+
+    def test_lazy_sections(self):
+        data = _response().to_bytes()
+        message, end = DNSMessage.parse(data)
+        self.assertEqual(end, 12 + len(encode_name('www.example.com.')) + 4)
+        self.assertNotIn('answers', message.__dict__)
+        self.assertEqual(len(message.authorities), 1)
+        self.assertEqual(len(message.answers), 3)
+
+    def test_section_assigned_before_decoding(self):
+        message, _ = DNSMessage.parse(_response().to_bytes())
+        message.answers = []
+        self.assertEqual(message.answers, [])
+        self.assertEqual(message.authorities[0].rtype, NS)
+        self.assertEqual(message.answers, [])
+
+    def test_section_assigned_after_decoding(self):
+        message, _ = DNSMessage.parse(_response().to_bytes())
+        self.assertEqual(len(message.answers), 3)
+        message.additionals = []
+        self.assertEqual(message.additionals, [])
+        self.assertEqual(len(message.answers), 3)
+
+    def test_copies_decode_on_their_own(self):
+        message, _ = DNSMessage.parse(_response().to_bytes())
+        copy = message.with_RD(is_desired=True)
+        self.assertEqual(len(copy.additionals), 1)
+        self.assertEqual(len(message.additionals), 1)
+        self.assertEqual(copy.to_bytes()[4:], message.to_bytes()[4:])
+
+
+class DNSMessageToBytesTest(unittest.TestCase):
+    def test_round_trip(self):
+        rng = random.Random(0)
+        for _ in range(300):
+            message = _random_message(rng)
+            data = message.to_bytes()
+            uncompressed = message.to_bytes(compress=False)
+            self.assertLessEqual(len(data), len(uncompressed))
+            for wire in (data, uncompressed):
+                parsed, _ = DNSMessage.parse(wire)
+                self.assertEqual(parsed.header, message.header)
+                self.assertEqual(parsed.questions, message.questions)
+                self.assertEqual(list(parsed.records()), list(message.records()))
+                self.assertEqual(parsed.to_bytes(), data)
+
+    def test_names_compare_without_case(self):
+        message = _message(answers=[DNSRecord('WWW.Example.COM.', A, 1, 300, 4, bytes(4))])
+        data = message.to_bytes()
+        self.assertEqual(len(data), len(message.to_bytes(compress=False)) - len(encode_name('www.example.com.')) + 2)
+        self.assertEqual(DNSMessage.parse(data)[0].answers[0].rname, 'www.example.com.')
+
+    def test_pointers_stay_below_0x4000(self):
+        # names first written past 0x3FFF can't be pointed at, earlier ones still are
+        early = [DNSRecord('host{}-{}.zone{}.example.'.format(k, 'x' * 40, k), A, 1, 300, 4, bytes(4))
+                 for k in range(400)]
+        late = [DNSRecord('www.zone{}.example.'.format(k), A, 1, 300, 4, bytes(4)) for k in range(350, 400)]
+        message = _message(answers=early + late)
+        data = message.to_bytes()
+        self.assertGreater(len(data), 0x4000)
+
+        pointers = _pointers(data)
+        self.assertTrue(all(target < min(position, 0x4000) for position, target in pointers))
+        self.assertTrue(any(position >= 0x4000 for position, _ in pointers))
+        self.assertEqual(list(DNSMessage.parse(data)[0].records()), list(message.records()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import unittest
+from unittest import mock
+from main.selection import ServerSelector
+
+FAST = ('ns1.example.', '192.0.2.1')
+SLOW = ('ns2.example.', '192.0.2.2')
+NEW = ('ns3.example.', '192.0.2.3')
+
+
+def _ordered(selector, servers):
+    # without the random exploration
+    with mock.patch('main.selection.random.random', return_value=0.5):
+        return selector.order(servers)
+
+
+class OrderTest(unittest.TestCase):
+    def test_fastest_first_unknown_before(self):
+        selector = ServerSelector()
+        selector.record_rtt(SLOW[1], 0.2)
+        selector.record_rtt(FAST[1], 0.01)
+        self.assertEqual(_ordered(selector, [SLOW, NEW, FAST]), [NEW, FAST, SLOW])
+
+    def test_smoothed(self):
+        selector = ServerSelector()
+        selector.record_rtt(FAST[1], 0.1)
+        selector.record_rtt(FAST[1], 0.9)
+        stats = selector.stats()[FAST[1]]
+        self.assertEqual(stats['srtt_ms'], 200.0)
+        self.assertEqual(stats['rttvar_ms'], 237.5)
+
+    def test_exploration(self):
+        selector = ServerSelector()
+        selector.record_rtt(FAST[1], 0.01)
+        selector.record_rtt(SLOW[1], 0.2)
+        with mock.patch('main.selection.random.random', return_value=0.0), \
+                mock.patch('main.selection.random.randrange', return_value=1):
+            self.assertEqual(selector.order([FAST, SLOW]), [SLOW, FAST])
+
+    def test_timeout(self):
+        selector = ServerSelector(min_timeout=0.2, max_timeout=5.0)
+        self.assertEqual(selector.timeout(NEW[1]), 5.0)
+        selector.record_rtt(FAST[1], 0.01)
+        self.assertEqual(selector.timeout(FAST[1]), 0.2)
+        selector.record_rtt(SLOW[1], 0.5)
+        self.assertEqual(selector.timeout(SLOW[1]), 1.5)
+
+
+class HolddownTest(unittest.TestCase):
+    def test_held_servers_last(self):
+        selector = ServerSelector()
+        with mock.patch('time.monotonic', return_value=100.0):
+            selector.record_failure(FAST[1])
+            selector.record_failure(SLOW[1])
+            selector.record_failure(SLOW[1])
+            # held the shortest first
+            self.assertEqual(_ordered(selector, [SLOW, FAST, NEW]), [NEW, FAST, SLOW])
+        with mock.patch('time.monotonic', return_value=101.0):
+            self.assertEqual(_ordered(selector, [SLOW, FAST, NEW])[-1], SLOW)
+
+    def test_backoff(self):
+        selector = ServerSelector()
+        with mock.patch('time.monotonic', return_value=100.0):
+            for failures in range(1, 9):
+                selector.record_failure(SLOW[1])
+                expected = min(ServerSelector.HOLDDOWN_BASE * 2 ** (failures - 1), ServerSelector.HOLDDOWN_MAX)
+                self.assertEqual(selector.stats()[SLOW[1]]['held_for'], expected)
+
+    def test_failure_doubles_srtt(self):
+        selector = ServerSelector(max_timeout=5.0)
+        selector.record_rtt(SLOW[1], 2.0)
+        selector.record_failure(SLOW[1])
+        self.assertEqual(selector.stats()[SLOW[1]]['srtt_ms'], 4000.0)
+        selector.record_failure(SLOW[1])
+        self.assertEqual(selector.stats()[SLOW[1]]['srtt_ms'], 5000.0)
+
+    def test_answer_releases(self):
+        selector = ServerSelector()
+        selector.record_failure(SLOW[1])
+        selector.record_rtt(SLOW[1], 0.05)
+        stats = selector.stats()[SLOW[1]]
+        self.assertEqual((stats['held_for'], stats['failures'], stats['timeouts']), (0.0, 0, 1))
+
+
+class PruneTest(unittest.TestCase):
+    def test_idle_servers_start_over(self):
+        selector = ServerSelector()
+        with mock.patch('time.monotonic', return_value=100.0):
+            selector.record_rtt(FAST[1], 0.01)
+            selector.record_failure(SLOW[1], timed_out=False)
+        with mock.patch('time.monotonic', return_value=600.0):
+            selector.record_rtt(NEW[1], 0.01)
+        with mock.patch('time.monotonic', return_value=100.0 + ServerSelector.IDLE_EXPIRY + 1):
+            self.assertEqual(selector.prune(), 2)
+            self.assertEqual(list(selector.stats()), [NEW[1]])
+            self.assertEqual(_ordered(selector, [FAST, NEW]), [FAST, NEW])
+
+
+class LowerBoundTest(unittest.TestCase):
+    def test_outrun_server_is_measured(self):
+        selector = ServerSelector()
+        selector.record_rtt(FAST[1], 0.01)
+        self.assertEqual(_ordered(selector, [FAST, SLOW]), [SLOW, FAST])
+
+        selector.record_lower_bound(SLOW[1], 0.3)
+        self.assertEqual(_ordered(selector, [FAST, SLOW]), [FAST, SLOW])
+        self.assertEqual(selector.stats()[SLOW[1]]['srtt_ms'], 300.0)
+
+    def test_raises_srtt_only(self):
+        selector = ServerSelector()
+        selector.record_rtt(SLOW[1], 0.5)
+        selector.record_lower_bound(SLOW[1], 0.2)
+        self.assertEqual(selector.stats()[SLOW[1]]['srtt_ms'], 500.0)
+        selector.record_lower_bound(SLOW[1], 0.8)
+        self.assertEqual(selector.stats()[SLOW[1]]['srtt_ms'], 800.0)
+
+    def test_keeps_holddown(self):
+        selector = ServerSelector()
+        selector.record_rtt(FAST[1], 0.01)
+        selector.record_failure(SLOW[1])
+        selector.record_lower_bound(SLOW[1], 0.3)
+        self.assertEqual(_ordered(selector, [SLOW, NEW, FAST]), [NEW, FAST, SLOW])
+        self.assertEqual(selector.stats()[SLOW[1]]['failures'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
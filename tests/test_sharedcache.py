@@ -0,0 +1,138 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from main.messages import DNSRecord
+from main.sharedcache import SharedAnswerCache, _SEQUENCE, _SLOT_HEADER
+from main.constants import *
+
+
+def _a(name, last_byte, ttl=300):
+    return DNSRecord(name, A, 1, ttl, 4, bytes([192, 0, 2, last_byte]))
+
+
+class SharedCacheTestCase(unittest.TestCase):
+    SLOTS = 4
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.location = os.path.join(self.directory.name, 'shared.cache')
+        self.cache = self._open()
+
+    def tearDown(self):
+        self.cache.close()
+        self.directory.cleanup()
+
+    def _open(self):
+        cache = SharedAnswerCache(self.location, slots=self.SLOTS, slot_size=128)
+        cache.open()
+        return cache
+
+    def _slot(self, name, rtype=A):
+        # offset of the slot holding the key
+        key = self.cache._key(name, rtype)
+        for offset in self.cache._offsets(key):
+            if self.cache._map[offset + _SLOT_HEADER.size:offset + _SLOT_HEADER.size + len(key)] == key:
+                return offset
+
+    def _colliding_names(self):
+        # two names whose first probe is the same slot
+        first = {}
+        for k in range(100):
+            name = 'host{}.example.'.format(k)
+            offset = next(self.cache._offsets(self.cache._key(name, A)))
+            if offset in first:
+                return first[offset], name
+            first[offset] = name
+
+
+class SharedAnswerCacheTest(SharedCacheTestCase):
+    def test_shared_between_mappings(self):
+        # a worker sees what another one wrote, and it's still there after a restart
+        self.cache.put('WWW.example.', A, [_a('www.example.', 1), _a('www.example.', 2)])
+        other = self._open()
+        try:
+            self.assertEqual([r.as_ip() for r in other.get('www.Example.', A)], ['192.0.2.1', '192.0.2.2'])
+            self.assertIsNone(other.get('www.example.', AAAA))
+        finally:
+            other.close()
+
+    def test_remaining_ttl(self):
+        with mock.patch('time.time', return_value=1000.0):
+            self.cache.put('www.example.', A, [_a('www.example.', 1, ttl=60), _a('www.example.', 2, ttl=30)])
+        with mock.patch('time.time', return_value=1010.5):
+            self.assertEqual([r.ttl for r in self.cache.get('www.example.', A)], [19, 19])
+        with mock.patch('time.time', return_value=1030.0):
+            self.assertIsNone(self.cache.get('www.example.', A))
+
+    def test_oversize(self):
+        records = [_a('www.example.', k) for k in range(10)]
+        self.cache.put('www.example.', A, records)
+        self.assertIsNone(self.cache.get('www.example.', A))
+        self.assertEqual(self.cache.oversize, 1)
+
+    def test_full_probes_overwrite_first_expiring(self):
+        names = ['host{}.example.'.format(k) for k in range(self.SLOTS + 1)]
+        for k, name in enumerate(names[:-1]):
+            self.cache.put(name, A, [_a(name, k, ttl=100 + k)])
+        self.cache.put(names[-1], A, [_a(names[-1], 99)])
+        self.assertEqual(self.cache.overwrites, 1)
+        self.assertIsNone(self.cache.get(names[0], A))
+        self.assertEqual([r.as_ip() for r in self.cache.get(names[-1], A)], ['192.0.2.99'])
+
+    def test_other_layout_starts_over(self):
+        self.cache.put('www.example.', A, [_a('www.example.', 1)])
+        self.cache.close()
+        self.cache = SharedAnswerCache(self.location, slots=self.SLOTS * 2, slot_size=128)
+        self.cache.open()
+        self.assertIsNone(self.cache.get('www.example.', A))
+
+
+class SeqlockTest(SharedCacheTestCase):
+    def test_interrupted_writer(self):
+        self.cache.put('www.example.', A, [_a('www.example.', 1)])
+        offset = self._slot('www.example.')
+        # a writer died between bumping the sequence to odd and back to even
+        sequence = _SEQUENCE.unpack_from(self.cache._map, offset)[0]
+        _SEQUENCE.pack_into(self.cache._map, offset, sequence + 1)
+        self.assertIsNone(self.cache.get('www.example.', A))
+
+        self.cache.put('www.example.', A, [_a('www.example.', 2)])
+        self.assertEqual(_SEQUENCE.unpack_from(self.cache._map, offset)[0] % 2, 0)
+        self.assertEqual([r.as_ip() for r in self.cache.get('www.example.', A)], ['192.0.2.2'])
+
+    def test_busy_slot_does_not_hide_later_probes(self):
+        first, second = self._colliding_names()
+        self.cache.put(first, A, [_a(first, 1)])
+        self.cache.put(second, A, [_a(second, 2)])
+        self.assertNotEqual(self._slot(first), self._slot(second))
+
+        offset = self._slot(first)
+        _SEQUENCE.pack_into(self.cache._map, offset, _SEQUENCE.unpack_from(self.cache._map, offset)[0] + 1)
+        self.assertIsNone(self.cache.get(first, A))
+        self.assertEqual([r.as_ip() for r in self.cache.get(second, A)], ['192.0.2.2'])
+
+
+    def _read_seeing(self, offset, sequences):
+        # the sequence numbers the reader finds, one per read of the slot's sequence
+        seen = list(sequences)
+        with mock.patch('main.sharedcache._SEQUENCE', mock.Mock(unpack_from=lambda *_: (seen.pop(0),))):
+            slot = self.cache._read_slot(offset)
+        self.assertEqual(seen, [])
+        return slot
+
+    def test_retries_while_written(self):
+        self.cache.put('www.example.', A, [_a('www.example.', 1)])
+        offset = self._slot('www.example.')
+        sequence = _SEQUENCE.unpack_from(self.cache._map, offset)[0]
+
+        self.assertIsNotNone(self._read_seeing(offset, [sequence + 1, sequence + 2, sequence + 2]))
+        self.assertEqual(self.cache.retries, 1)
+        # written while the slot was copied
+        self.assertIsNotNone(self._read_seeing(offset, [sequence, sequence + 2, sequence + 2, sequence + 2]))
+        self.assertEqual(self.cache.retries, 2)
+        self.assertIsNone(self._read_seeing(offset, [sequence + 1] * self.cache.READ_RETRIES))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest import mock
+from main.messages import DNSRecord
+from main.storage import CacheStorage, CacheWriteQueue, SCHEMA_VERSION
+from main.utils import encode_name
+from main.constants import *
+
+
+def _a(name, last_byte, ttl=300):
+    return DNSRecord(name, A, 1, ttl, 4, bytes([192, 0, 2, last_byte]))
+
+
+def _ns(zone, nameserver, ttl=3600):
+    return DNSRecord(zone, NS, 1, ttl, len(encode_name(nameserver)), nameserver.encode())
+
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.location = os.path.join(self.directory.name, 'cache.db')
+        self.storage = CacheStorage(self.location)
+
+    def tearDown(self):
+        self.storage.close()
+        self.directory.cleanup()
+
+
+class MigrationTest(StorageTestCase):
+    def _version_0(self, rows):
+        # the table as the resolver wrote it before there was a schema version
+        conn = sqlite3.connect(self.location)
+        conn.execute('CREATE TABLE cache (name TEXT, type INT, ttl INT, insertion_time INT, data BLOB, ns TEXT);')
+        conn.executemany('INSERT INTO cache(name, type, ttl, insertion_time, data, ns) VALUES (?, ?, ?, ?, ?, ?);', [
+            (record.rname, record.rtype, record.ttl, inserted, record.to_bytes(),
+             record.rdata.decode() if record.rtype == NS else None)
+            for record, inserted in rows
+        ])
+        conn.commit()
+        conn.close()
+
+    def _user_version(self):
+        conn = sqlite3.connect(self.location)
+        try:
+            return conn.execute('PRAGMA user_version;').fetchone()[0]
+        finally:
+            conn.close()
+
+    def _indexes(self):
+        conn = sqlite3.connect(self.location)
+        try:
+            return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index';")}
+        finally:
+            conn.close()
+
+    def test_new_file(self):
+        self.storage.open()
+        self.assertEqual(self._user_version(), SCHEMA_VERSION)
+        self.assertEqual(self.storage.lookup_answer('www.example.com.', A, int(time.time())), [])
+
+    def test_from_version_0(self):
+        now = int(time.time())
+        self._version_0([
+            (_a('WWW.Example.com.', 1), now - 100),
+            (_a('old.example.com.', 2, ttl=60), now - 100),
+            (_ns('Example.COM.', 'NS1.example.com.'), now - 100),
+            (_a('ns1.example.com.', 53), now - 100),
+        ])
+        self.storage.open()
+        self.assertEqual(self._user_version(), SCHEMA_VERSION)
+        self.assertIn('cache_expires_at', self._indexes())
+
+        # live rows are kept with their original expiry, names lowercased
+        rows = self.storage.lookup_answer('www.example.com.', A, now)
+        self.assertEqual([(DNSRecord.parse(data, 0)[0].as_ip(), expires_at) for data, expires_at in rows],
+                         [('192.0.2.1', now + 200)])
+        self.assertEqual(self.storage.lookup_answer('old.example.com.', A, now - 100), [])
+        delegates = self.storage.lookup_delegates('example.com.', now)
+        self.assertEqual([DNSRecord.parse(data, 0)[0].as_ip() for data, _ in delegates], ['192.0.2.53'])
+
+    def test_migrates_once(self):
+        self.storage.open()
+        now = int(time.time())
+        self.storage.insert_many([(_a('www.example.com.', 1), now)])
+        self.storage.close()
+
+        self.storage.open()
+        self.assertEqual(len(self.storage.lookup_answer('www.example.com.', A, now)), 1)
+
+    def test_newer_version(self):
+        conn = sqlite3.connect(self.location)
+        conn.execute('PRAGMA user_version = {};'.format(SCHEMA_VERSION + 1))
+        conn.close()
+        with self.assertRaises(Exception):
+            self.storage.open()
+
+
+class CacheStorageTest(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.storage.open()
+
+    def test_replaces_same_rdata(self):
+        now = int(time.time())
+        self.storage.insert_many([(_a('www.example.com.', 1), now - 10), (_a('www.example.com.', 2), now - 10)])
+        self.storage.insert_many([(_a('www.example.com.', 1, ttl=600), now)])
+        rows = self.storage.lookup_answer('www.Example.com.', A, now)
+        self.assertEqual(sorted(expires_at for _, expires_at in rows), [now + 290, now + 600])
+
+    def test_sweep(self):
+        now = int(time.time())
+        self.storage.insert_many([(_a('www.example.com.', 1, ttl=60), now), (_a('mail.example.com.', 1), now)])
+        self.assertEqual(self.storage.sweep(now + 60), 1)
+        self.assertEqual(self.storage.lookup_answer('www.example.com.', A, now), [])
+        self.assertEqual(len(self.storage.lookup_answer('mail.example.com.', A, now)), 1)
+
+
+
+class CacheWriteQueueTest(unittest.TestCase):
+    def _ips(self, rows):
+        return sorted(DNSRecord.parse(data, 0)[0].as_ip() for data, _ in rows)
+
+    def test_found_until_written(self):
+        queue = CacheWriteQueue()
+        now = int(time.time())
+        queue.add([_a('WWW.example.com.', 1), _a('www.example.com.', 2)], now)
+        self.assertEqual(self._ips(queue.lookup('www.example.com.', A, now)), ['192.0.2.1', '192.0.2.2'])
+
+        batch = queue.take()
+        self.assertEqual(len(CacheWriteQueue.rows(batch)), 2)
+        self.assertEqual(self._ips(queue.lookup('www.example.com.', A, now)), ['192.0.2.1', '192.0.2.2'])
+        self.assertIsNone(queue.take())
+
+        queue.done(batch)
+        self.assertEqual(queue.lookup('www.example.com.', A, now), [])
+        self.assertEqual(len(queue), 0)
+
+    def test_newest_rrset_wins(self):
+        queue = CacheWriteQueue()
+        now = int(time.time())
+        queue.add([_a('www.example.com.', 1)], now)
+        queue.take()
+        queue.add([_a('www.example.com.', 2)], now)
+        self.assertEqual(self._ips(queue.lookup('www.example.com.', A, now)), ['192.0.2.2'])
+
+    def test_expired(self):
+        queue = CacheWriteQueue()
+        now = int(time.time())
+        queue.add([_a('www.example.com.', 1, ttl=60)], now)
+        self.assertEqual(queue.lookup('www.example.com.', A, now + 60), [])
+
+    def test_full(self):
+        queue = CacheWriteQueue(max_size=2)
+        now = int(time.time())
+        queue.add([_a('www.example.com.', 1), _a('www.example.com.', 1)], now)
+        self.assertFalse(queue.full())
+        queue.add([_a('mail.example.com.', 1)], now)
+        self.assertTrue(queue.full())
+        queue.take()
+        self.assertFalse(queue.full())
+
+    def test_due(self):
+        queue = CacheWriteQueue(flush_interval=1.0)
+        self.assertFalse(queue.due())
+        with mock.patch('time.monotonic', return_value=100.0):
+            queue.add([_a('www.example.com.', 1)], int(time.time()))
+        with mock.patch('time.monotonic', return_value=100.5):
+            self.assertFalse(queue.due())
+        with mock.patch('time.monotonic', return_value=101.0):
+            self.assertTrue(queue.due())
+            queue.take()
+            self.assertFalse(queue.due())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+from unittest import mock
+from main.zonecuts import ZoneCutCache
+
+NOW = 1000000.0
+
+
+def _at(now):
+    return mock.patch('time.time', return_value=now)
+
+
+def _cuts():
+    # com. and example.com. with addresses, sub.example.com. without
+    cuts = ZoneCutCache()
+    with _at(NOW):
+        cuts.add_delegation('com.', 'a.gtld-servers.net.', 3600)
+        cuts.add_address('a.gtld-servers.net.', '192.0.2.30', 3600)
+        cuts.add_delegation('Example.COM.', 'NS1.example.com.', 300)
+        cuts.add_address('ns1.example.com.', '192.0.2.53', 300)
+        cuts.add_delegation('sub.example.com.', 'ns.sub.example.com.', 300)
+    return cuts
+
+
+class FindTest(unittest.TestCase):
+    def test_deepest_cut(self):
+        with _at(NOW):
+            self.assertEqual(_cuts().find('www.EXAMPLE.com.'), ('example.com.', [('ns1.example.com.', '192.0.2.53')]))
+
+    def test_zone_apex(self):
+        with _at(NOW):
+            self.assertEqual(_cuts().find('example.com.')[0], 'example.com.')
+
+    def test_cut_without_addresses_is_skipped(self):
+        with _at(NOW):
+            self.assertEqual(_cuts().find('www.sub.example.com.')[0], 'example.com.')
+
+    def test_expired_cut_falls_back_to_parent(self):
+        with _at(NOW + 300):
+            self.assertEqual(_cuts().find('www.example.com.'), ('com.', [('a.gtld-servers.net.', '192.0.2.30')]))
+
+    def test_unknown(self):
+        cuts = _cuts()
+        with _at(NOW):
+            self.assertIsNone(cuts.find('www.example.net.'))
+        self.assertEqual((cuts.lookups, cuts.hits), (1, 0))
+
+    def test_address_shared_by_zones(self):
+        cuts = _cuts()
+        with _at(NOW):
+            cuts.add_delegation('example.org.', 'ns1.example.com.', 300)
+            self.assertEqual(cuts.find('www.example.org.'), ('example.org.', [('ns1.example.com.', '192.0.2.53')]))
+
+
+class MissingAddressesTest(unittest.TestCase):
+    def test_missing(self):
+        cuts = _cuts()
+        with _at(NOW):
+            self.assertEqual(cuts.missing_addresses('sub.example.com.'), ['ns.sub.example.com.'])
+            self.assertEqual(cuts.missing_addresses('example.com.'), [])
+            self.assertEqual(cuts.servers('sub.example.com.'), [])
+
+    def test_unresolvable(self):
+        cuts = _cuts()
+        with _at(NOW):
+            cuts.mark_unresolvable('ns.sub.example.com.', 60)
+            self.assertEqual(cuts.missing_addresses('sub.example.com.'), [])
+        with _at(NOW + 60):
+            self.assertEqual(cuts.missing_addresses('sub.example.com.'), ['ns.sub.example.com.'])
+            cuts.add_address('ns.sub.example.com.', '192.0.2.54', 300)
+            self.assertEqual(cuts.servers('sub.example.com.'), [('ns.sub.example.com.', '192.0.2.54')])
+
+
+class PruneTest(unittest.TestCase):
+    def test_prune(self):
+        cuts = _cuts()
+        with _at(NOW + 300):
+            # the NS records and address of example.com. and the NS record of sub.example.com.
+            self.assertEqual(cuts.prune(), 3)
+            stats = cuts.stats()
+            self.assertEqual((stats['zones'], stats['nameservers'], stats['nameservers_with_addresses']), (1, 1, 1))
+            self.assertEqual(cuts.find('www.sub.example.com.')[0], 'com.')
+
+
+if __name__ == '__main__':
+    unittest.main()